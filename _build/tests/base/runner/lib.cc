@@ -0,0 +1,5 @@
+  int answer()
+  {
+    return 51;
+  }
+  
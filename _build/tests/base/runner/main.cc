@@ -0,0 +1,8 @@
+#include <iostream>
+
+int answer();
+
+int main()
+{
+  std::cout << "out " << answer() << std::endl;
+}
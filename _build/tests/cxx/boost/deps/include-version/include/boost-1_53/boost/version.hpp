@@ -0,0 +1,6 @@
+#ifndef VERSION_HPP
+# define VERSION_HPP
+
+# define BOOST_VERSION 105300
+
+#endif
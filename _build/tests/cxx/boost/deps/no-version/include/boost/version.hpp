@@ -0,0 +1,4 @@
+#ifndef VERSION_HPP
+# define VERSION_HPP
+
+#endif
@@ -0,0 +1 @@
+#include "branch-2.hh"
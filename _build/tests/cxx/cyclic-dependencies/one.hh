@@ -0,0 +1 @@
+#include "two.hh"
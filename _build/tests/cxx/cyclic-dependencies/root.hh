@@ -0,0 +1,2 @@
+#include "one.hh"
+#include "root-1.hh"
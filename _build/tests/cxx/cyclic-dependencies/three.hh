@@ -0,0 +1 @@
+#include "one.hh"
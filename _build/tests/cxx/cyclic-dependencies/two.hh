@@ -0,0 +1,2 @@
+#include "branch-1.hh"
+#include "three.hh"
@@ -0,0 +1,5 @@
+#include <algorithm>
+
+int main()
+{}
+
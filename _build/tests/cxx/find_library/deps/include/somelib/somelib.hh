@@ -0,0 +1,6 @@
+#ifndef SOMELIB_HH
+# define SOMELIB_HH
+
+
+
+#endif
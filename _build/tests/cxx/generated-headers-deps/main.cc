@@ -0,0 +1,4 @@
+#include <gen/generated.hh>
+
+int main()
+{}
@@ -0,0 +1,6 @@
+void test();
+
+int main()
+{
+  test();
+}
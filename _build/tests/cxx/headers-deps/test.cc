@@ -0,0 +1,8 @@
+#include <iostream>
+
+#include "test.hh"
+
+void test()
+{
+  std::cout << MESSAGE << "!" << std::endl;
+}
@@ -0,0 +1 @@
+#define MESSAGE "updated"
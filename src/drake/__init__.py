@@ -10,9 +10,21 @@ import os as _OS
 import atexit
 import collections
 import contextlib
+import drake.cache
 import drake.debug
+import drake.executor
+import drake.hashing
+import drake.process
+import drake.resources
+import drake.server
+import drake.state
+import drake.statcache
+import drake.trace
+import drake.watch
+import asyncio
 import hashlib
 import inspect
+import io
 import itertools
 import pickle
 import pipes
@@ -27,6 +39,7 @@ import threading
 import time
 import types
 import warnings
+import weakref
 
 from drake.deprecation import deprecated
 from drake.sched import Coroutine, Scheduler
@@ -47,6 +60,39 @@ def _scheduled():
     Coroutine.current._Coroutine__scheduler
 
 
+def _build_nodes(nodes, exception_join = False):
+  """Build nodes concurrently.
+
+  A coroutine is only started for nodes whose builder is not running
+  yet: targets of a builder already being run are waited for
+  directly, and its failure raised as soon as it ends.
+  """
+  builders = set()
+  with drake.sched.Scope(exception_join = exception_join) as scope:
+    for node in nodes:
+      if node.skippable():
+        continue
+      builder = node.builder
+      if builder is not None and not node.dependencies and \
+         not _customized_build(node):
+        if builder in builders:
+          continue
+        builders.add(builder)
+        signal = builder._Builder__executed_signal
+        if signal is not None:
+          scope.wait(signal)
+          continue
+      scope.run(node.build, str(node), priority = node.critical_path)
+
+
+def _customized_build(node):
+  """Whether node overrides how it is built."""
+  cls = node.__class__
+  return cls.build not in (BaseNode.build, Node.build) or \
+    cls._build not in (BaseNode._build, Node._build) or \
+    cls.polish is not BaseNode.polish
+
+
 def path_source(path = None):
   if path is None:
     return Drake.current.path_source
@@ -74,13 +120,50 @@ class Drake:
     return self.__jobs
 
   def jobs_set(self, n):
-    n = int(n)
-    if n == 1:
-      self.__jobs_lock = None
+    """Set the number of concurrent jobs, or 'auto' to fit the
+    available CPUs, memory and load."""
+    if n == 'auto':
+      self.__jobs_auto = True
+      n = drake.resources.cpu_count()
     else:
-      self.__jobs_lock = drake.sched.Semaphore(n)
+      self.__jobs_auto = False
+      n = int(n)
+    self.__jobs = n
+    self.__scheduler.jobs = n
+    self.__jobs_lock_update()
   jobs.setter(jobs_set)
 
+  @property
+  def max_memory(self):
+    """The maximum expected memory of concurrent jobs, in bytes."""
+    return self.__max_memory
+
+  def max_memory_set(self, size):
+    self.__max_memory = \
+      drake.resources.size(size) if size is not None else None
+    self.__jobs_lock_update()
+
+  @property
+  def max_load(self):
+    """The load average above which no job is started."""
+    return self.__max_load
+
+  def max_load_set(self, load):
+    self.__max_load = float(load) if load is not None else None
+    self.__jobs_lock_update()
+
+  def __jobs_lock_update(self):
+    if self.__jobs_auto or self.__max_memory is not None or \
+       self.__max_load is not None:
+      self.__jobs_lock = drake.resources.Limiter(
+        jobs = self.__jobs,
+        max_memory = self.__max_memory,
+        max_load = self.__max_load)
+    elif self.__jobs == 1:
+      self.__jobs_lock = None
+    else:
+      self.__jobs_lock = drake.sched.Semaphore(self.__jobs)
+
   @property
   def path_source(self):
     """The path to the source directory relative to the build directory."""
@@ -103,16 +186,40 @@ class Drake:
   def jobs_lock(self):
     return self.__jobs_lock
 
+  @property
+  def state(self):
+    """The persistent build state database."""
+    if self.__state is None:
+      self.__state = drake.state.State(Builder.CACHEDIR / 'state.db')
+      # Hashes computed with another algorithm cannot be compared.
+      previous = self.__state.get('drake', 'hash', 'sha1')
+      if previous != self.__hash_algorithm:
+        logger.log('drake.hash', drake.log.LogLevel.log,
+                   'hash algorithm changed from %s to %s, '
+                   'forgetting dependencies', previous,
+                   self.__hash_algorithm)
+        self.__state.clear('hashes')
+        self.__state.clear('depfiles')
+        self.__state.set('drake', 'hash', self.__hash_algorithm)
+    return self.__state
+
   __previous = []
 
   def __enter__(self):
     Drake.__previous.append(Drake.current)
     Drake.current = self
+    drake.trace.Trace.current = self.__trace
     return self
 
   def __exit__(self, *args):
+    if self.__state is not None:
+      self.__state.flush()
+    if self.__trace is not None:
+      self.__trace.write()
     Drake.current = Drake.__previous[-1]
     del Drake.__previous[-1]
+    drake.trace.Trace.current = \
+      Drake.current.trace if Drake.current is not None else None
 
   @property
   def prefix(self):
@@ -159,16 +266,49 @@ class Drake:
                use_mtime = None,
                adjust_mtime = None,
                adjust_mtime_future = None,
-               adjust_mtime_second = None):
+               adjust_mtime_second = None,
+               paranoid_hash = None,
+               action_cache = None,
+               remote_cache = None,
+               executor = None,
+               critical_path = None,
+               trace = None,
+               max_memory = None,
+               max_load = None,
+               snapshot = None,
+               lazy_include = None,
+               hash_algorithm = None,
+               stat_cache = None,
+               early_cutoff = None):
     if root is None:
       root = drake.Path('.')
     self.__jobs = 1
+    self.__jobs_auto = False
     self.__jobs_lock = None
+    self.__max_memory = None
+    self.__max_load = None
     self.__kill_builders_on_failure = kill_builders_on_failure
     self.__nodes = {}
     self.__prefix = drake.Path('.')
-    self.__scheduler = Scheduler(policy = drake.sched.DepthFirst())
+    self.__critical_path = self.__option(
+      'CRITICAL_PATH', False, critical_path)
+    self.__critical_paths_up = {}
+    self.__critical_paths_down = {}
+    self.__topological_orders = {}
+    # node -> the builders using it as a dynamic source and the nodes
+    # depending on it, static sources being its consumers. Built by
+    # the first invalidation, then kept up to date.
+    self.__dependents = None
+    self.__scheduler = Scheduler(
+      policy = drake.sched.CriticalPath() if self.__critical_path
+      else drake.sched.DepthFirst())
     self.__source = drake.Path(root)
+    self.__state = None
+    self.__trace = None
+    if trace is None:
+      trace = _OS.environ.get('DRAKE_TRACE')
+    if trace is not None:
+      self.trace_set(trace)
     self.__use_mtime = self.__option(
       'MTIME', True, use_mtime)
     self.__adjust_mtime = self.__option(
@@ -177,6 +317,46 @@ class Drake:
       'ADJUST_MTIME_FUTURE', False, adjust_mtime_future)
     self.__adjust_mtime_second = self.__option(
       'ADJUST_MTIME_SECOND', False, adjust_mtime_second)
+    self.__paranoid_hash = self.__option(
+      'PARANOID_HASH', False, paranoid_hash)
+    self.__early_cutoff = self.__option(
+      'EARLY_CUTOFF', True, early_cutoff)
+    if hash_algorithm is None:
+      hash_algorithm = _OS.environ.get('DRAKE_HASH', 'sha1')
+    # Fail early on unknown or unavailable algorithms.
+    drake.hashing.hasher(hash_algorithm)
+    self.__hash_algorithm = hash_algorithm
+    self.__snapshot = self.__option('SNAPSHOT', False, snapshot)
+    self.__lazy_include = self.__option('LAZY_INCLUDE', False, lazy_include)
+    if self.__option('STAT_CACHE', True, stat_cache):
+      self.__stat_cache = drake.statcache.StatCache()
+    else:
+      self.__stat_cache = drake.statcache.Uncached()
+    self.__lazy = []
+    self.__drakefiles = []
+    if action_cache is None and 'DRAKE_ACTION_CACHE' in _OS.environ:
+      size = _OS.environ.get('DRAKE_ACTION_CACHE_SIZE')
+      action_cache = drake.cache.ActionCache(
+        _OS.environ['DRAKE_ACTION_CACHE'],
+        size = int(size) if size is not None else None,
+        compress = self.__option('ACTION_CACHE_COMPRESS', False))
+    elif isinstance(action_cache, (str, Path)):
+      action_cache = drake.cache.ActionCache(action_cache)
+    if remote_cache is None:
+      remote_cache = _OS.environ.get('DRAKE_REMOTE_CACHE')
+    if isinstance(remote_cache, str):
+      remote_cache = drake.cache.RemoteCache(remote_cache)
+    if remote_cache is not None:
+      if action_cache is None:
+        action_cache = remote_cache
+      else:
+        action_cache = drake.cache.Caches([action_cache, remote_cache])
+    self.__action_cache = action_cache
+    if executor is None and 'DRAKE_WORKERS' in _OS.environ:
+      executor = drake.executor.RemoteExecutor(
+        drake.executor.workers(_OS.environ['DRAKE_WORKERS']),
+        _OS.environ.get('DRAKE_WORKERS_KEY', '').encode('utf-8'))
+    self.__executor = executor
     # Load the root drakefile
     self.__globals = {}
     path = str(self.path_source / 'drakefile')
@@ -192,6 +372,10 @@ class Drake:
       self.__configure = None
     if jobs is not None:
       self.jobs_set(jobs)
+    if max_memory is not None:
+      self.max_memory_set(max_memory)
+    if max_load is not None:
+      self.max_load_set(max_load)
 
   @property
   def kill_builders_on_failure(self):
@@ -205,6 +389,12 @@ class Drake:
   def adjust_mtime(self):
     return self.__adjust_mtime
 
+  @property
+  def early_cutoff(self):
+    """Whether targets an execution leaves unchanged keep their
+    former mtime, so their consumers need not check them."""
+    return self.__early_cutoff
+
   @property
   def adjust_mtime_future(self):
     return self.__adjust_mtime_future
@@ -213,6 +403,165 @@ class Drake:
   def adjust_mtime_second(self):
     return self.__adjust_mtime_second
 
+  @property
+  def action_cache(self):
+    """The cache builders outputs are restored from, if any."""
+    return self.__action_cache
+
+  @property
+  def executor(self):
+    """The executor hermetic commands are run on, if any."""
+    return self.__executor
+
+  @property
+  def trace(self):
+    """The trace build activity is recorded in, if any."""
+    return self.__trace
+
+  def trace_set(self, path):
+    """Record build activity in a Chrome trace file at path."""
+    self.__trace = drake.trace.Trace(path)
+    if Drake.current is self:
+      drake.trace.Trace.current = self.__trace
+
+  @property
+  def critical_path(self):
+    """Whether builders on the longest chains, according to the
+    durations recorded in previous runs, are scheduled first."""
+    return self.__critical_path
+
+  @property
+  def paranoid_hash(self):
+    """Whether to always rehash files instead of trusting the hash
+    cache when their metadata is unchanged."""
+    return self.__paranoid_hash
+
+  @property
+  def hash_algorithm(self):
+    """The algorithm files are hashed with, see drake.hashing."""
+    return self.__hash_algorithm
+
+  @property
+  def stat_cache(self):
+    """The file metadata of the build, see drake.statcache.
+
+    Listings of directories are cached during a build unless
+    DRAKE_STAT_CACHE is 0.
+    """
+    return self.__stat_cache
+
+  @property
+  def lazy_include(self):
+    """Whether included drakefiles are only evaluated once a node
+    under their directory, or one of their variables, is needed."""
+    return self.__lazy_include
+
+  def lazy_load(self, path = None):
+    """Evaluate pending lazy includes whose directory contains
+    path, or all of them. Return whether any was evaluated."""
+    res = False
+    while True:
+      pending = [module for module in self.__lazy
+                 if path is None or module.prefix.prefix_of(path)]
+      if not pending:
+        return res
+      for module in pending:
+        module._LazyModule__load()
+      res = True
+
+  @property
+  def snapshot(self):
+    """Whether the graph built by configure is saved, and reloaded
+    instead of configuring again when nothing it depends on changed."""
+    return self.__snapshot
+
+  def __snapshot_key(self, kwcfg):
+    """Digest of what the graph depends on besides drakefiles:
+    configure arguments, environment and drake itself."""
+    h = hashlib.sha1()
+    h.update(repr(sorted(kwcfg.items())).encode('utf-8'))
+    h.update(repr(sorted(
+      (k, v) for k, v in _OS.environ.items()
+      if k not in _SNAPSHOT_ENVIRON_IGNORE)).encode('utf-8'))
+    root = _OS.path.dirname(__file__)
+    for directory, dirs, files in sorted(_OS.walk(root)):
+      dirs.sort()
+      for name in sorted(files):
+        if name.endswith('.py'):
+          path = _OS.path.join(directory, name)
+          st = _OS.stat(path)
+          h.update(repr((path, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+  @staticmethod
+  def __drakefile_digest(path):
+    try:
+      with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+      return None
+
+  def __snapshot_load(self, key):
+    """Restore the snapshot graph if it is still valid."""
+    snapshot = self.state.get('snapshot', 'graph')
+    if snapshot is None or snapshot['key'] != key:
+      return False
+    for path, digest in snapshot['drakefiles'].items():
+      if self.__drakefile_digest(path) != digest:
+        logger.log('drake.snapshot', drake.log.LogLevel.log,
+                   '%s changed, configuring', path)
+        return False
+    try:
+      with profile_unpickling():
+        graph = drake.Path.Unpickler(io.BytesIO(snapshot['graph'])).load()
+    except Exception as e:
+      logger.log('drake.snapshot', drake.log.LogLevel.log,
+                 'unable to load snapshot: %s', e)
+      return False
+    self.__nodes = graph['nodes']
+    self.__dependents = None
+    self.__drakefiles = list(snapshot['drakefiles'])
+    _DEFAULTS[:] = graph['defaults']
+    _MODES.update(graph['modes'])
+    BaseNode.uid = max(BaseNode.uid, graph['uid'])
+    return True
+
+  def __snapshot_save(self, key, modes):
+    """Save the graph built by configure.
+
+    modes -- The modes before configuring: modes added since are
+             saved too.
+    """
+    if self.__lazy:
+      logger.log('drake.snapshot', drake.log.LogLevel.log,
+                 'lazy includes are pending, not saving a snapshot')
+      self.state.remove('snapshot', 'graph')
+      return
+    graph = {
+      'nodes': self.__nodes,
+      'defaults': _DEFAULTS,
+      'modes': dict((name, mode) for name, mode in _MODES.items()
+                    if modes.get(name) is not mode),
+      'uid': BaseNode.uid,
+    }
+    f = io.BytesIO()
+    try:
+      with profile_pickling():
+        drake.Path.Pickler(f).dump(graph)
+    except (pickle.PicklingError, AttributeError, TypeError,
+            RecursionError) as e:
+      # Builders holding lambdas, for instance, cannot be saved.
+      logger.log('drake.snapshot', drake.log.LogLevel.log,
+                 'unable to snapshot the graph: %s', e)
+      self.state.remove('snapshot', 'graph')
+      return
+    self.state.set('snapshot', 'graph', {
+      'key': key,
+      'drakefiles': dict((path, self.__drakefile_digest(path))
+                         for path in self.__drakefiles),
+      'graph': f.getvalue(),
+    })
+
   def notify(self, status, message, start, stop=None):
     '''Notify the user that a run was finished.'''
     icon = str(self.path_source / 'logo.png')
@@ -233,105 +582,167 @@ class Drake:
              + ') 2>/dev/null').format_map(args)
       _OS.system(cmd)
 
-  def run(self, *cfg, **kwcfg):
-    start = time.time()
-    try:
-      configure = self.__configure
-      specs = inspect.getfullargspec(configure)
-      # Load positional arguments
-      for effective, formal in zip(cfg, specs.args):
-        if formal in kwcfg:
-          raise TypeError(
-            "%s() got multiple values for argument %r", specs.name, formal)
-        else:
-          kwcfg[formal] = effective
-      # Parse arguments
-      options = {
-        '--jobs': lambda j: self.jobs_set(j),
-        '-j': lambda j: self.jobs_set(j),
-        '--help': help,
-        '-h': help,
-        '--complete-modes': complete_modes,
-        '--complete-options': complete_options,
-        '--complete-nodes': complete_nodes,
-      }
-      arguments_re = re.compile('--(\\w+)=(.*)')
-      callbacks = []
-      i = 0
-      args = sys.argv[1:]
-      while i < len(args):
-        match = arguments_re.match(args[i])
-        if match:
-          name = match.group(1)
-          value = match.group(2)
-          if name in specs.args:
-            kwcfg[name] = value
-            del args[i]
-            continue
-        elif args[i] in options:
-          opt = args[i]
+  def __arguments(self, cfg, kwcfg, args):
+    """Parse the command line arguments.
+
+    Return the configure arguments, the callbacks to run once
+    configured and the remaining mode and node arguments.
+    """
+    configure = self.__configure
+    specs = inspect.getfullargspec(configure)
+    kwcfg = dict(kwcfg)
+    args = list(args)
+    # Load positional arguments
+    for effective, formal in zip(cfg, specs.args):
+      if formal in kwcfg:
+        raise TypeError(
+          "%s() got multiple values for argument %r", specs.name, formal)
+      else:
+        kwcfg[formal] = effective
+    # Parse arguments
+    options = {
+      '--jobs': lambda j: self.jobs_set(j),
+      '-j': lambda j: self.jobs_set(j),
+      '--trace': lambda path: self.trace_set(path),
+      '--max-memory': lambda size: self.max_memory_set(size),
+      '--max-load': lambda load: self.max_load_set(load),
+      '--help': help,
+      '-h': help,
+      '--complete-modes': complete_modes,
+      '--complete-options': complete_options,
+      '--complete-nodes': complete_nodes,
+    }
+    arguments_re = re.compile('--([\\w-]+)=(.*)')
+    callbacks = []
+    i = 0
+    while i < len(args):
+      match = arguments_re.match(args[i])
+      if match:
+        name = match.group(1)
+        value = match.group(2)
+        option = options.get('--%s' % name)
+        if name in specs.args:
+          kwcfg[name] = value
+          del args[i]
+          continue
+        elif option is not None and \
+             len(inspect.getfullargspec(option).args) == 1:
           del args[i]
-          opt_args = []
-          for a in inspect.getfullargspec(options[opt]).args:
-            opt_args.append(args[i])
-            del args[i]
-          cb = options[opt](*opt_args)
+          cb = option(value)
           if cb is not None:
             callbacks.append(cb)
           continue
-        i += 1
-      # Load default values
-      if specs.defaults is not None:
-        for arg, d in zip(reversed(specs.args),
-                          reversed(specs.defaults)):
-          if arg not in kwcfg:
-            kwcfg[arg] = d
-      # Apply annotations
-      for name in list(kwcfg):
-        if name in specs.annotations:
-          value = kwcfg[name]
-          t = specs.annotations[name]
-          if t is bool and isinstance(value, str):
-            if value.lower() in ['true', 'yes']:
-              value = True
-            elif value.lower() in ['false', 'no']:
-              value = False
-            else:
-              raise Exception('invalid value for '
-                              'boolean option %s: %s' % (name, value))
-          elif hasattr(t, '__drake_configure__'):
-            value = getattr(t, '__drake_configure__')(t, value)
+      elif args[i] in options:
+        opt = args[i]
+        del args[i]
+        opt_args = []
+        for a in inspect.getfullargspec(options[opt]).args:
+          opt_args.append(args[i])
+          del args[i]
+        cb = options[opt](*opt_args)
+        if cb is not None:
+          callbacks.append(cb)
+        continue
+      i += 1
+    # Load default values
+    if specs.defaults is not None:
+      for arg, d in zip(reversed(specs.args),
+                        reversed(specs.defaults)):
+        if arg not in kwcfg:
+          kwcfg[arg] = d
+    # Apply annotations
+    for name in list(kwcfg):
+      if name in specs.annotations:
+        value = kwcfg[name]
+        t = specs.annotations[name]
+        if t is bool and isinstance(value, str):
+          if value.lower() in ['true', 'yes']:
+            value = True
+          elif value.lower() in ['false', 'no']:
+            value = False
           else:
-            value = t(value)
-          kwcfg[name] = value
+            raise Exception('invalid value for '
+                            'boolean option %s: %s' % (name, value))
+        elif hasattr(t, '__drake_configure__'):
+          value = getattr(t, '__drake_configure__')(t, value)
+        else:
+          value = t(value)
+        kwcfg[name] = value
+    return kwcfg, callbacks, args
+
+  def __build(self, args):
+    """Run the modes on the nodes given on the command line."""
+    mode = _MODES['build']
+    i = 0
+    with self:
+      while True:
+        if i < len(args):
+          arg = args[i]
+          if arg[0:2] == '--':
+            arg = arg[2:]
+            if arg in _MODES:
+              mode = _MODES[arg]
+            else:
+              raise Exception('Unknown option: %s.' % arg)
+            i += 1
+        nodes = []
+        while i < len(args) and args[i][0:2] != '--':
+          nodes.append(node(args[i]))
+          i += 1
+        if not nodes:
+          self.lazy_load()
+          nodes = _DEFAULTS
+        mode(nodes)
+        if i == len(args):
+          break
+
+  @property
+  def server(self):
+    """The path of the build server socket."""
+    return Builder.CACHEDIR / 'server.sock'
+
+  def run(self, *cfg, **kwcfg):
+    start = time.time()
+    args = sys.argv[1:]
+    serve = '--server' in args
+    watch = '--watch' in args
+    if serve:
+      args.remove('--server')
+    elif watch:
+      args.remove('--watch')
+    elif '--server-stop' in args:
+      if drake.server.request(self.server, sys.argv, stop = True) is None:
+        print('%s: no build server is running' % sys.argv[0])
+        sys.exit(1)
+      return
+    elif self.__option('SERVER', True):
+      status = drake.server.request(self.server, sys.argv)
+      if status is not None:
+        sys.exit(status)
+    try:
+      configure = self.__configure
+      kwcfg, callbacks, args = self.__arguments(cfg, kwcfg, args)
       # Configure
       with self:
-        configure(**kwcfg)
+        self.__drakefiles = [str(self.path_source / 'drakefile')]
+        if self.__snapshot:
+          key = self.__snapshot_key(kwcfg)
+          if not self.__snapshot_load(key):
+            modes = dict(_MODES)
+            configure(**kwcfg)
+            self.__snapshot_save(key, modes)
+        else:
+          configure(**kwcfg)
       # Run callbacks.
       for cb in callbacks:
         cb()
-      mode = _MODES['build']
-      i = 0
-      with self:
-        while True:
-          if i < len(args):
-            arg = args[i]
-            if arg[0:2] == '--':
-              arg = arg[2:]
-              if arg in _MODES:
-                mode = _MODES[arg]
-              else:
-                raise Exception('Unknown option: %s.' % arg)
-              i += 1
-          nodes = []
-          while i < len(args) and args[i][0:2] != '--':
-            nodes.append(node(args[i]))
-            i += 1
-          if not nodes:
-            nodes = _DEFAULTS
-          mode(nodes)
-          if i == len(args):
-            break
+      if serve:
+        self.__serve(cfg)
+        return
+      if watch:
+        self.__watch(args)
+      else:
+        self.__build(args)
     except Exception as e:
       self.notify(1, str(e), start)
       print('%s: %s' % (sys.argv[0], e))
@@ -344,6 +755,323 @@ class Drake:
       sys.exit(1)
     self.notify(0, ' '.join(args), start)
 
+  def __configuration(self, argv):
+    """The configure arguments given in argv, as strings."""
+    args = inspect.getfullargspec(self.__configure).args
+    return sorted(arg for arg in argv[1:]
+                  if re.match('--([\\w-]+)=', arg) and
+                  arg[2:].split('=', 1)[0] in args)
+
+  def __state_stamp(self):
+    try:
+      st = _OS.stat(self.state.path)
+      return (st.st_ino, st.st_size, st.st_mtime_ns)
+    except OSError:
+      return None
+
+  @staticmethod
+  def __node_reset(n):
+    n._BaseNode__hash = None
+    n._BaseNode__skippable = False
+    if isinstance(n, Node):
+      n._Node__exists = False
+      n._Node__mtime = None
+
+  @staticmethod
+  def __builder_reset(builder):
+    builder._Builder__executed = False
+    builder._Builder__executed_exception = None
+    builder._Builder__executed_signal = None
+    builder._Builder__state_entries = None
+    builder._Builder__sources_dyn = None
+    builder._depfiles = None
+    builder._depfile = DepFile(builder, 'drake')
+
+  def __reset(self):
+    """Forget what was learned about the tree during the previous
+    build, so modifications made since are noticed."""
+    for hook in _INVALIDATION_HOOKS:
+      hook(None)
+    self.__stat_cache.clear()
+    Path.forget()
+    for n in self.__nodes.values():
+      self.__node_reset(n)
+    for builder in Builder.builders:
+      self.__builder_reset(builder)
+    self.__critical_paths_up.clear()
+    self.__critical_paths_down.clear()
+
+  def __invalidate(self, nodes, builders):
+    """Forget what was learned about the given modified nodes, and
+    rebuild the given builders and everything downstream of them.
+    """
+    for hook in _INVALIDATION_HOOKS:
+      hook(nodes)
+    self.__stat_cache.clear()
+    Path.forget()
+    dependents = self.__dependents
+    if dependents is None:
+      dependents = self.__dependents = {}
+      for builder in Builder.builders:
+        for source in builder.sources_dynamic():
+          self.__dependent_add(source, builder)
+      for n in self.__nodes.values():
+        for dependency in n.dependencies:
+          self.__dependent_add(dependency, n)
+    todo = list(nodes) + list(builders)
+    done = set()
+    while todo:
+      item = todo.pop()
+      if item in done:
+        continue
+      done.add(item)
+      if isinstance(item, Builder):
+        self.__builder_reset(item)
+        todo.extend(item.targets())
+      else:
+        self.__node_reset(item)
+        todo.extend(item.consumers)
+        todo.extend(dependents.get(item, ()))
+    if done:
+      self.__critical_paths_up.clear()
+      self.__critical_paths_down.clear()
+
+  def __dependent_add(self, node, dependent):
+    """Record that dependent, a builder or a node, depends on node."""
+    dependents = self.__dependents
+    if dependents is not None:
+      dependents.setdefault(node, {})[dependent] = None
+
+  def __topological(self, nodes):
+    """The builders the nodes depend on, each after the builders of
+    its sources.
+
+    The order is kept until nodes or builders are added.
+    """
+    key = tuple(nodes)
+    cached = self.__topological_orders.get(key)
+    if cached is not None and \
+       cached[0] == (len(self.__nodes), Builder.uid):
+      return cached[1]
+    res = []
+    visited = set()
+    stack = [(n, False) for n in reversed(key)]
+    while stack:
+      item, visited_sources = stack.pop()
+      if visited_sources:
+        res.append(item)
+        continue
+      if item in visited:
+        continue
+      visited.add(item)
+      if isinstance(item, Builder):
+        stack.append((item, True))
+        try:
+          item._Builder__reload_dyndeps()
+        except Exception:
+          pass
+        stack.extend((source, False)
+                     for source in chain(item.sources().values(),
+                                         item.sources_dynamic()))
+      else:
+        if item.builder is not None:
+          stack.append((item.builder, False))
+        stack.extend((dependency, False) for dependency in item.dependencies)
+    # Versioned once dynamic dependencies, which may add nodes, are
+    # loaded.
+    version = (len(self.__nodes), Builder.uid)
+    self.__topological_orders[key] = (version, res)
+    return res
+
+  def __fast_forward(self, nodes):
+    """Check the builders the nodes depend on in topological order,
+    and mark those that are up to date as executed.
+
+    This runs in the calling coroutine, so none is started for the
+    parts of the graph that need no execution. Builders that do, or
+    that this cannot decide on, are left for the scheduler.
+    """
+    ready = {}
+
+    def built(node):
+      """Whether node is as it would be after being built."""
+      res = ready.get(node)
+      if res is None:
+        # Guard against dependency cycles.
+        ready[node] = False
+        builder = node.builder
+        if _customized_build(node):
+          # Let nodes customizing their build be built.
+          res = False
+        elif builder is None:
+          res = not node.missing()
+        else:
+          res = builder._Builder__executed and \
+            builder._Builder__executed_exception is None
+        res = res and all(built(d) for d in node.dependencies)
+        ready[node] = res
+      return res
+
+    with logger.log('drake.Builder',
+                    drake.log.LogLevel.trace,
+                    'check builders in topological order'):
+      for builder in self.__topological(nodes):
+        if builder._Builder__executed or \
+           builder._Builder__executed_signal is not None:
+          continue
+        if builder.__class__.run is not Builder.run:
+          # Let builders customizing their run be run.
+          continue
+        try:
+          if builder._Builder__reload_dyndeps():
+            continue
+          if not all(built(source) for source in chain(
+              builder.sources().values(), builder.sources_dynamic())):
+            continue
+          if builder._Builder__needs_execution(False):
+            continue
+        except Exception:
+          # Let the scheduler run it, and report the error.
+          continue
+        builder._Builder__executed = True
+        logger.log('drake.Builder',
+                   drake.log.LogLevel.debug,
+                   '%s: everything is up to date', builder)
+
+  def __watch(self, args):
+    """Build, then rebuild what depends on modified files until
+    interrupted."""
+    watcher = drake.watch.watcher()
+    try:
+      while True:
+        try:
+          self.__build(args)
+        except Exception as e:
+          print('%s: %s' % (sys.argv[0], e))
+        self.state.flush()
+        # Source files, and directories where new files may change
+        # what builders depend on.
+        sources = collections.defaultdict(list)
+        targets = set()
+        directories = {}
+        failed = []
+        for n in list(self.__nodes.values()):
+          if isinstance(n, Node):
+            path = _OS.path.normpath(str(n.path()))
+            if n.builder is None:
+              sources[path].append(n)
+              directories.setdefault(_OS.path.dirname(path) or '.', [])
+            else:
+              targets.add(path)
+        for builder in Builder.builders:
+          if builder.build_status is False:
+            failed.append(builder)
+          for directory in builder.watch_directories():
+            directory = _OS.path.normpath(str(directory))
+            directories.setdefault(directory, []).append(builder)
+        listings = {}
+        for directory, builders in directories.items():
+          watcher.watch(directory)
+          if builders:
+            try:
+              listings[directory] = set(_OS.listdir(directory))
+            except OSError:
+              listings[directory] = set()
+        print('%s: watching %s files for modifications'
+              % (sys.argv[0], len(sources)))
+        sys.stdout.flush()
+        while True:
+          changed = watcher.wait()
+          if changed is None:
+            self.__reset()
+            break
+          nodes = [n for path in changed for n in sources.get(path, ())]
+          # Other files only matter when they appear in a directory
+          # watched by builders, where they may shadow a dependency.
+          # Ignore what drake writes, and editors temporary files.
+          builders = []
+          for path in changed:
+            directory, name = _OS.path.split(path)
+            directory = directory or '.'
+            if path in sources or path in targets or \
+               name.startswith('.') or \
+               name in listings.get(directory, (name,)) or \
+               not _OS.path.isfile(path):
+              continue
+            builders += directories[directory]
+            listings[directory].add(name)
+          if nodes or builders:
+            self.__invalidate(nodes, builders + failed)
+            break
+    finally:
+      watcher.close()
+
+  def __serve(self, cfg):
+    """Serve build requests from clients, see drake.server."""
+    environ = dict(_OS.environ)
+    configuration = self.__configuration(drake.server.ARGV)
+    jobs = 'auto' if self.__jobs_auto else self.__jobs
+    trace = self.__trace
+    digests = {}
+    self.state.flush()
+    stamp = [self.__state_stamp()]
+
+    def handle(argv, environ_client):
+      for path in self.__drakefiles:
+        digest = self.__drakefile_digest(path)
+        if digests.setdefault(path, digest) != digest:
+          self.state.flush()
+          return {'reload': '%s changed' % path}
+      changed = sorted(
+        k for k in set(environ) | set(environ_client)
+        if environ.get(k) != environ_client.get(k) and
+        k not in _SERVER_ENVIRON_IGNORE)
+      if changed:
+        return {'local': 'the environment differs (%s)' % ', '.join(changed)}
+      if self.__configuration(argv) != configuration:
+        return {'local': 'the configuration differs'}
+      # Someone else built meanwhile: reload the build state.
+      if self.__state_stamp() != stamp[0]:
+        self.__state = None
+      self.__reset()
+      self.jobs_set(jobs)
+      status = 0
+      start = time.time()
+      argv_server = sys.argv
+      sys.argv = argv
+      try:
+        with self:
+          _, callbacks, args = self.__arguments(cfg, {}, argv[1:])
+          for cb in callbacks:
+            cb()
+          self.__build(args)
+        self.notify(0, ' '.join(args), start)
+      except Exception as e:
+        self.notify(1, str(e), start)
+        print('%s: %s' % (argv[0], e))
+        if 'DRAKE_DEBUG_BACKTRACE' in _OS.environ:
+          import traceback
+          traceback.print_exc()
+        status = 1
+      except KeyboardInterrupt:
+        print('%s: interrupted.' % argv[0])
+        status = 1
+      except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 0
+      finally:
+        sys.argv = argv_server
+        self.state.flush()
+        stamp[0] = self.__state_stamp()
+        # Traces requested by clients were written when leaving.
+        self.__trace = trace
+        drake.trace.Trace.current = trace
+      return {'status': status}
+
+    server = drake.server.Server(self.server, handle)
+    print('%s: serving builds on %s' % (sys.argv[0], server.path))
+    sys.stdout.flush()
+    server.serve()
+
 
 EXPLAIN = 'DRAKE_EXPLAIN' in _OS.environ
 
@@ -474,9 +1202,36 @@ _SILENT = 'DRAKE_SILENT' in _OS.environ
 
 class Path:
 
-  """Node names, similar to a filesystem path."""
+  """Node names, similar to a filesystem path.
+
+  Paths are interned in a trie: each path is its last component and
+  a pointer to its parent, and is unique for given components and
+  flags, so they can be compared by identity. Taking the dirname,
+  appending a component or testing prefixes thus walks pointers
+  instead of copying component tuples. Parents only refer weakly to
+  their children, so paths nothing refers to anymore are freed, and
+  their entries dropped by Path.forget.
+  """
 
+  __slots__ = (
+    '__parent',
+    '__name',
+    '__children',
+    '__kind',
+    '__len',
+    '__str',
+    '__canonized',
+    '__weakref__',
+  )
+
+  # Recently parsed strings, up to CACHE_SIZE of them.
   cache = {}
+  CACHE_SIZE = 1 << 16
+
+  # (absolute, virtual, volume) -> the empty path.
+  __roots = {}
+  # Held while adding children, so paths stay unique.
+  __lock = threading.Lock()
 
   def __new__(self,
               path,
@@ -495,19 +1250,112 @@ class Path:
         path, absolute, virtual, volume = Path.__parse(path)
     else:
       strkey = string
-    if Path.windows:
-      key = (path, absolute, virtual, volume)
-    else:
-      key = (path, absolute, virtual)
-    res = Path.cache.get(key, None)
-    if res is None:
-      res = object.__new__(self)
-      res.__init(path, absolute, virtual, volume)
-      Path.cache[key] = res
+    res = Path.__root(absolute, virtual, volume)
+    for component in path:
+      res = res.__child(component)
     if strkey is not None:
-      Path.cache[strkey] = res
+      cache = Path.cache
+      if len(cache) >= Path.CACHE_SIZE:
+        cache.clear()
+      cache[strkey] = res
+    return res
+
+  @staticmethod
+  def __root(absolute, virtual, volume):
+    key = (absolute, virtual, volume if Path.windows else None)
+    res = Path.__roots.get(key)
+    if res is None:
+      res = object.__new__(Path)
+      res.__parent = None
+      res.__name = None
+      res.__children = None
+      res.__kind = (absolute, virtual, volume)
+      res.__len = 0
+      res.__str = None
+      res.__canonized = None
+      res = Path.__roots.setdefault(key, res)
     return res
 
+  @staticmethod
+  def forget():
+    """Forget interned paths nothing refers to anymore.
+
+    Long running sessions call it between builds, so the trie does
+    not keep every path ever used.
+    """
+    Path.cache.clear()
+    with Path.__lock:
+      for root in Path.__roots.values():
+        root.__forget()
+
+  def __forget(self):
+    children = self.__children
+    if children is None:
+      return
+    for name, ref in list(children.items()):
+      child = ref()
+      if child is None:
+        del children[name]
+      else:
+        child.__forget()
+    if not children:
+      self.__children = None
+
+  def __child(self, component):
+    """The path with component appended, interned."""
+    children = self.__children
+    ref = None if children is None else children.get(component)
+    res = None if ref is None else ref()
+    if res is None:
+      with Path.__lock:
+        # Another thread may have added it meanwhile.
+        children = self.__children
+        if children is None:
+          children = self.__children = {}
+        ref = children.get(component)
+        res = None if ref is None else ref()
+        if res is None:
+          res = object.__new__(Path)
+          res.__parent = self
+          res.__name = component
+          res.__children = None
+          res.__kind = self.__kind
+          res.__len = self.__len + 1
+          res.__str = None
+          res.__canonized = None
+          children[component] = weakref.ref(res)
+    return res
+
+  @property
+  def __path(self):
+    """The components, as a tuple."""
+    res = []
+    p = self
+    while p.__parent is not None:
+      res.append(p.__name)
+      p = p.__parent
+    res.reverse()
+    return tuple(res)
+
+  @property
+  def __absolute(self):
+    return self.__kind[0]
+
+  @property
+  def __virtual(self):
+    return self.__kind[1]
+
+  @property
+  def __volume(self):
+    return self.__kind[2]
+
+  def __ancestor(self, depth):
+    """The prefix of this path with depth components."""
+    p = self
+    for i in range(self.__len - depth):
+      p = p.__parent
+    return p
+
   def unfold(self):
     p = self
     while p != drake.Path.dot:
@@ -571,20 +1419,16 @@ class Path:
   if windows:
     separator = '\\'
 
-  def __init(self, path, absolute, virtual, volume):
-    """Build a path.
-
-    path -- The path, as a string or an other Path.
-    """
-    self.__absolute = absolute
-    self.__canonized = None
-    self.__path = path
-    self.__str = None
-    self.__virtual = virtual
-    self.__volume = volume
-
   def canonize(self):
+    # True if the path is canonical, rather than a reference to itself
+    # which would keep it alive.
     if self.__canonized is None:
+      p = self
+      while p.__parent is not None and p.__name not in ('.', '..'):
+        p = p.__parent
+      if p.__parent is None:
+        self.__canonized = True
+        return self
       res = ()
       path = self.__path
       for i in range(len(path)):
@@ -595,13 +1439,13 @@ class Path:
         else:
           res += (path[i],)
       if res == self.__path:
-        self.__canonized = self
+        self.__canonized = True
       else:
         self.__canonized = drake.Path(res,
                                       absolute = self.__absolute,
                                       virtual = self.__virtual,
                                       volume = self.__volume)
-    return self.__canonized
+    return self if self.__canonized is True else self.__canonized
 
   def absolute(self):
       """Whether this path is absolute.
@@ -681,9 +1525,16 @@ class Path:
         shutil.rmtree(str(self))
       else:
         raise
+    finally:
+      self.__modified()
+
+  def __modified(self):
+    """Forget the cached metadata of this path."""
+    if Drake.current is not None:
+      Drake.current.stat_cache.invalidate(str(self))
 
   def __extension_get(self):
-    parts = self.__path[-1].split('.')
+    parts = self.__name.split('.')
     if len(parts) > 1:
       return '.'.join(parts[1:])
     else:
@@ -701,22 +1552,16 @@ class Path:
     >>> p.with_extension('txt')
     Path("foo.txt")
     '''
-    parts = self.__path[-1].split('.')
+    parts = self.__name.split('.')
     if len(parts) > 1:
       if value == '':
         parts = [parts[0]]
       else:
         parts = [parts[0], value]
-      return Path(self.__path[:-1] + ('.'.join(parts),),
-                  absolute = self.__absolute,
-                  virtual = self.__virtual,
-                  volume = self.__volume)
+      return self.__parent.__child('.'.join(parts))
     else:
       if value != '':
-        return Path(self.__path[:-1] + ('%s.%s' % (parts[0], value),),
-                    absolute = self.__absolute,
-                    virtual = self.__virtual,
-                    volume = self.__volume)
+        return self.__parent.__child('%s.%s' % (parts[0], value))
       else:
         return self
 
@@ -767,10 +1612,16 @@ class Path:
         prefix = drake.Path.separator * 2
       else:
         prefix = ''
-      if not self.__path:
+      if self.__parent is None:
         body = '.'
+      elif self.__parent.__parent is None:
+        body = self.__name
       else:
-        body = self.separator.join(self.__path)
+        # Reuse the parent string, they are likely needed too.
+        body = str(self.__parent)
+        if self.__parent.__kind[0] or self.__parent.__kind[1]:
+          body = body[len(prefix):]
+        body = body + self.separator + self.__name
       self.__str = prefix + body
     return self.__str
 
@@ -845,12 +1696,9 @@ class Path:
     >>> Path('foo/bar/baz').basename()
     Path("baz")
     """
-    if not self.__path:
+    if self.__parent is None:
       raise Exception('Cannot take the basename of an empty path.')
-    return Path(self.__path[-1:],
-                absolute = False,
-                virtual = False,
-                volume = '')
+    return Path.__root(False, False, '').__child(self.__name)
 
   def dirname(self):
     """The directory part of the path.
@@ -863,13 +1711,12 @@ class Path:
     >>> Path('foo').dirname()
     Path(".")
     """
-    if len(self.__path) == 1:
+    if self.__len == 1:
       return Path.dot
+    elif self.__parent is None:
+      return self
     else:
-      return Path(self.__path[0:-1],
-                  absolute = self.__absolute,
-                  virtual = self.__virtual,
-                  volume = self.__volume)
+      return self.__parent
 
   def touch(self):
     """Create the designated file if it does not exists.
@@ -898,6 +1745,7 @@ class Path:
     if not _OS.path.exists(str(self)):
       with open(str(self), 'w'):
         pass
+      self.__modified()
 
   def mkpath(self):
     """Create the designated directory.
@@ -912,6 +1760,7 @@ class Path:
     """
     if not _OS.path.exists(str(self)):
         _OS.makedirs(str(self))
+        self.__modified()
 
   def __eq__(self, rhs):
     """Whether self equals rhs.
@@ -956,10 +1805,10 @@ class Path:
       return self
     if rhs.__absolute:
       return rhs
-    return drake.Path(self.__path + rhs.__path,
-                      absolute = self.__absolute,
-                      virtual = self.__virtual,
-                      volume = self.__volume)
+    res = self
+    for component in rhs.__path:
+      res = res.__child(component)
+    return res
 
   def prefix_of(self, rhs):
     """Whether self is a prefix of rhs.
@@ -972,12 +1821,13 @@ class Path:
     >>> p.prefix_of('nope')
     False
     """
-    rhs = drake.Path(rhs).canonize().__path
-    path = self.__path
-    while len(rhs) and len(path) and path[0] == rhs[0]:
-      rhs = rhs[1:]
-      path = path[1:]
-    return len(path) == 0
+    rhs = drake.Path(rhs).canonize()
+    if self.__len > rhs.__len:
+      return False
+    if self.__kind is rhs.__kind:
+      return rhs.__ancestor(self.__len) is self
+    # Prefixes are only about components.
+    return rhs.__ancestor(self.__len).__path == self.__path
 
   def without_prefix(self, rhs, force = True):
     """Remove rhs prefix from self.
@@ -1008,7 +1858,20 @@ class Path:
     >>> Path('foo/bar').without_prefix('foo/bar')
     Path(".")
     """
-    rhs = drake.Path(rhs).canonize().__path
+    rhs = drake.Path(rhs).canonize()
+    if rhs.__len <= self.__len and \
+       self.__ancestor(rhs.__len) is rhs and self.__len > rhs.__len:
+      # Common case: take the last components.
+      res = []
+      p = self
+      while p is not rhs:
+        res.append(p.__name)
+        p = p.__parent
+      p = Path.__root(False, False, '')
+      for component in reversed(res):
+        p = p.__child(component)
+      return p
+    rhs = rhs.__path
     path = self.__path
     while len(rhs) and len(path) and path[0] == rhs[0]:
       rhs = rhs[1:]
@@ -1026,7 +1889,7 @@ class Path:
                       volume = '')
 
   def __len__(self):
-    return len(self.__path)
+    return self.__len
 
   def without_suffix(self, rhs):
     """Remove rhs suffix from self.
@@ -1107,7 +1970,44 @@ class Path:
 Path.dot = Path('.')
 Path.dotdot = Path('..')
 
-_DEPFILE_BUILDER = Path('drake.Builder')
+_DEPFILE_BUILDER = 'drake.Builder'
+# When the execution that last left the targets unchanged started,
+# see Builder.__cutoff.
+_DEPFILE_CUTOFF = 'drake.cutoff'
+
+
+def _depfiles_legacy(cachedir):
+  """Import the dependency files of the legacy per-builder layout.
+
+  Older versions stored each dependency file, and the builder hash,
+  as a separate pickle file in the builder cachedir. Load them in the
+  format of the build state and remove them from the disk.
+  """
+  res = {}
+  if not cachedir.exists():
+    return res
+  with profile_unpickling():
+    for name in cachedir.list():
+      path = cachedir / name
+      if name == 'stdout' or not path.is_file():
+        continue
+      try:
+        with open(str(path), 'rb') as f:
+          if name == _DEPFILE_BUILDER:
+            res[name] = pickle.Unpickler(f).load()
+          else:
+            unpickled = drake.Path.Unpickler(f).load()
+            if isinstance(unpickled, dict):
+              res[name] = {'hashes': unpickled, 'dirty': False}
+            elif isinstance(unpickled, tuple):
+              res[name] = unpickled[1]
+            else:
+              res[name] = None
+      except Exception:
+        if name != _DEPFILE_BUILDER:
+          res[name] = None
+      path.remove()
+  return res
 
 
 class DepFile:
@@ -1124,9 +2024,19 @@ class DepFile:
   A dependency file is attached to a builder, and has a name since
   one builder may have several dependencies files if dependencies
   come from different sources. Each file stores several (file, hash)
-  assocations.
+  assocations. Dependency files are kept in the build state database
+  (see Drake.state), under the builder cachedir.
   """
 
+  __slots__ = (
+    '__builder',
+    'name',
+    '__files',
+    '__invalid',
+    '__hashes',
+    '__dirty',
+  )
+
   def __init__(self, builder, name):
     """Construct a dependency file for builder with given name."""
     self.__builder = builder
@@ -1150,34 +2060,24 @@ class DepFile:
   def dirty(self, dirty):
     self.__dirty = dirty
     self.save()
+    # The dirty mark must hit the disk before the builder is executed,
+    # lest an interrupted build leave a stale, clean looking state.
+    Drake.current.state.flush()
 
   def register(self, node, source = True):
     """Add the node to the hashed files."""
     self.__files.append((node, source))
 
-  def path(self):
-    """Path to the file storing the hashes."""
-    return self.__builder.cachedir / self.name
-
   def read(self):
-    """Read the hashes from the store file."""
-    if self.path().exists():
-      with profile_unpickling():
-        try:
-          with open(str(self.path()), 'rb') as f:
-            unpickled = drake.Path.Unpickler(f).load()
-            if unpickled is None:
-              self.__invalid = True
-            if isinstance(unpickled, dict):
-              self.__hashes = unpickled
-            elif isinstance(unpickled, tuple):
-              content = unpickled[1]
-              self.__dirty = content['dirty']
-              self.__hashes = content['hashes']
-            else:
-              self.__invalid = True
-        except Exception:
-          self.__invalid = True
+    """Read the hashes from the build state."""
+    entries = self.__builder._Builder__state()
+    if self.name in entries:
+      content = entries[self.name]
+      if content is None:
+        self.__invalid = True
+      else:
+        self.__dirty = content['dirty']
+        self.__hashes = content['hashes']
     else:
       self.__hashes = {}
 
@@ -1194,6 +2094,7 @@ class DepFile:
     '''
     if self.__invalid:
       return False
+    self.__prefetch(oldest_mtime, mtime_implemented)
     res = True
     for path, (old_hash, data) in self.__hashes.items():
       if old_hash is None:
@@ -1231,8 +2132,50 @@ class DepFile:
         return False
     return res
 
+  # Below this many files, up to date checks do not go to threads.
+  PREFETCH_MIN = 16
+
+  def __prefetch(self, oldest_mtime, mtime_implemented):
+    """Stat and hash the files in parallel, on the scheduler thread
+    pool, ahead of up_to_date which then finds the results memoized
+    on the nodes."""
+    if not _scheduled():
+      return
+    nodes = []
+    for path, (old_hash, data) in self.__hashes.items():
+      if old_hash is not None:
+        n = node(path)
+        if isinstance(n, Node) and n._BaseNode__hash is None:
+          nodes.append(n)
+    if len(nodes) < DepFile.PREFETCH_MIN:
+      return
+    use_mtime = Drake.current.use_mtime
+
+    def check(nodes):
+      for n in nodes:
+        try:
+          if n.missing():
+            continue
+          # Like up_to_date, only hash files more recent than the
+          # targets.
+          if use_mtime and mtime_implemented and \
+             oldest_mtime is not None and n.mtime < oldest_mtime:
+            continue
+          n.hash()
+        except Exception:
+          # Reported by up_to_date.
+          pass
+
+    threads = max(Drake.current.jobs, _OS.cpu_count() or 1)
+    with drake.sched.Scope() as scope:
+      for i in range(min(threads, len(nodes))):
+        chunk = nodes[i::threads]
+        scope.run(lambda chunk = chunk:
+                  drake.sched.background(lambda: check(chunk)),
+                  '%s: check dependencies' % self.__builder)
+
   def update(self):
-    """Rehash all files and write to the store file."""
+    """Rehash all files and write to the build state."""
     self.__hashes = dict(
       (node.name_absolute(), (node.hash() if source else None,
                               node.drake_type()))
@@ -1241,15 +2184,13 @@ class DepFile:
     self.save()
 
   def save(self):
+    """Write the hashes to the build state."""
     content = {'hashes': self.__hashes, 'dirty': self.__dirty}
-    with profile_pickling():
-      path = self.path()
-      with open(str(path), 'wb') as f:
-        pickle.Pickler(f).dump((0, content))
+    self.__builder._Builder__state_update(self.name, content)
 
   def remove(self):
-    """Rehash all files and write to the store file."""
-    self.path().remove()
+    """Remove the hashes from the build state."""
+    self.__builder._Builder__state_update(self.name, None)
 
   def __repr__(self):
     """Python representation."""
@@ -1295,6 +2236,23 @@ def path_root():
     return Path(_OS.getcwd())
 
 
+def _stat_signature(st):
+  """The metadata identifying a file content without reading it."""
+  return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _stat_signature_valid(signature):
+  """Whether all files of a hash signature are unchanged."""
+  try:
+    for path, follow, *expected in signature:
+      st = _OS.stat(path) if follow else _OS.lstat(path)
+      if _stat_signature(st) != tuple(expected):
+        return False
+  except OSError:
+    return False
+  return True
+
+
 class _BaseNodeTypeType(type):
 
   node_types = {}
@@ -1336,6 +2294,20 @@ class BaseNode(object, metaclass = _BaseNodeType):
   source node, a generated file in the case of a target node), in
   which case its type is Node."""
 
+  # Drakefiles may attach their own attributes to nodes: the
+  # dictionary is only allocated for the nodes they do it on.
+  __slots__ = (
+    '__dict__',
+    '__name',
+    '_uid',
+    '_builder',
+    '__consumers',
+    '__dependencies',
+    '__hash',
+    '__skippable',
+  )
+
+  # The uid of the next node.
   uid = 0
   extensions = {}
 
@@ -1346,11 +2318,13 @@ class BaseNode(object, metaclass = _BaseNodeType):
       raise Exception('%s is outside the build directory' % name)
     if Drake.current.nodes.setdefault(self.__name, self) is not self:
       raise NodeRedefinition(self.__name)
-    self.uid = BaseNode.uid
+    self._uid = BaseNode.uid
     BaseNode.uid += 1
     self._builder = None
-    self.consumers = []
-    self.__dependencies = drake.sched.OrderedSet()
+    # Most nodes have neither consumers nor dependencies: allocate
+    # those on demand.
+    self.__consumers = None
+    self.__dependencies = None
     self.__hash = None
     self.__skippable = False
 
@@ -1372,11 +2346,11 @@ class BaseNode(object, metaclass = _BaseNodeType):
     if self in marks:
       return True
     marks[self] = None
-    print('  node_%s [label="%s"]' % (self.uid, self.__name))
+    print('  node_%s [label="%s"]' % (self._uid, self.__name))
     if self.builder is not None:
       if self.builder.dot(marks):
-        print('  builder_%s -> node_%s' % (self.builder.uid,
-                                           self.uid))
+        print('  builder_%s -> node_%s' % (self.builder._uid,
+                                           self._uid))
     return True
 
   def compilation_database(self):
@@ -1425,19 +2399,75 @@ class BaseNode(object, metaclass = _BaseNodeType):
     is, roughly, run this node runner.
     """
     if not _scheduled():
-      Coroutine(self.build, str(self), Drake.current.scheduler)
+      self.__build_start()
       Drake.current.scheduler.run()
     else:
       with logger.log('drake.Builder',
                       drake.log.LogLevel.trace,
                       '%s: build', self):
         self._build()
-        with drake.sched.Scope() as scope:
-          for dep in self.dependencies:
-            if not dep.skippable():
-              scope.run(dep.build, str(dep))
+        _build_nodes(self.dependencies)
         self.polish()
 
+  async def build_async(self):
+    """Build this node from the current asyncio event loop.
+
+    The loop keeps running other tasks meanwhile, and commands run as
+    asyncio subprocesses instead of holding a thread each.
+    """
+    self.__build_start()
+    await Drake.current.scheduler.run_async()
+
+  def __build_start(self):
+    def build():
+      Drake.current._Drake__fast_forward((self,))
+      self.build()
+    Coroutine(build, str(self), Drake.current.scheduler,
+              priority = self.critical_path)
+
+  def critical_path(self):
+    """The estimated duration of the longest chain of builders going
+    through this node, in seconds.
+
+    The chain goes from the sources this node is built from down to
+    the nodes that do not feed any other. Durations are the ones
+    recorded for each builder in previous runs; builders that never
+    ran count for nothing.
+    """
+    return self.__path_up() + self.__path_down()
+
+  def __path_up(self):
+    """The longest chain from the builders consuming this node to the
+    final nodes."""
+    paths = Drake.current._Drake__critical_paths_up
+    res = paths.get(self)
+    if res is None:
+      # Guard against dependency cycles.
+      paths[self] = 0
+      res = max((target._BaseNode__path_up() + (consumer.duration or 0)
+                 for consumer in self.consumers
+                 for target in consumer.targets()),
+                default = 0)
+      paths[self] = res
+    return res
+
+  def __path_down(self):
+    """The longest chain from the sources to this node."""
+    paths = Drake.current._Drake__critical_paths_down
+    res = paths.get(self)
+    if res is None:
+      paths[self] = 0
+      res = 0
+      builder = self.builder
+      if builder is not None:
+        res = max((source._BaseNode__path_down()
+                   for source in chain(builder.sources().values(),
+                                       builder.sources_dynamic())),
+                  default = 0)
+        res += builder.duration or 0
+      paths[self] = res
+    return res
+
   def _build(self):
     if self.builder is not None:
       self.builder.run()
@@ -1528,9 +2558,25 @@ class BaseNode(object, metaclass = _BaseNodeType):
     self._builder = builder
     Drake.current.nodes[self._BaseNode__name] = self
 
+  @property
+  def consumers(self):
+    """The builders using this node as a source."""
+    consumers = self.__consumers
+    return consumers if consumers is not None else ()
+
+  def consumer_add(self, builder):
+    if self.__consumers is None:
+      self.__consumers = [builder]
+    else:
+      self.__consumers.append(builder)
+
   def dependency_add(self, dep):
     assert dep is not None
+    if self.__dependencies is None:
+      self.__dependencies = drake.sched.OrderedSet()
     self.__dependencies.add(dep)
+    if Drake.current is not None:
+      Drake.current._Drake__dependent_add(dep, self)
 
   def dependencies_add(self, deps):
     for dep in deps:
@@ -1538,15 +2584,16 @@ class BaseNode(object, metaclass = _BaseNodeType):
 
   @property
   def dependencies(self):
-    return self.__dependencies
+    dependencies = self.__dependencies
+    return dependencies if dependencies is not None else ()
 
   @property
   def final_dependencies(self):
-    return self.__dependencies
+    return self.dependencies
 
   @property
   def dependencies_recursive(self):
-    for dep in self.__dependencies:
+    for dep in self.dependencies:
       yield dep
       for sub in dep.dependencies_recursive:
         yield sub
@@ -1557,31 +2604,52 @@ class BaseNode(object, metaclass = _BaseNodeType):
     return self.name_absolute() < rhs.name_absolute()
 
   def hash(self):
-    """Digest of the file as a string."""
-
-    def _hash_file(hasher, path):
-      if _OS.path.isdir(str(path)):
-        for sub_path in _OS.listdir(str(path)):
-          _hash_file(hasher, _OS.path.join(str(path), str(sub_path)))
-      elif _OS.path.islink(str(path)):
-        hasher.update(_OS.readlink(str(path)).encode('utf-8'))
+    """Digest of the file as a string.
+
+    Digests are cached in the build state along with the metadata of
+    the hashed files, and reused without reading the files as long as
+    that metadata is unchanged, unless Drake.paranoid_hash is set.
+    """
+
+    def _hash_file(hasher, path, signature):
+      if _OS.path.isdir(path):
+        signature.append((path, True) + _stat_signature(_OS.stat(path)))
+        for sub_path in _OS.listdir(path):
+          _hash_file(hasher, _OS.path.join(path, sub_path), signature)
       else:
-        with open(str(path), 'rb') as f:
-          while True:
-            chunk = f.read(8192)
-            if not chunk:
-              break
-            hasher.update(chunk)
+        signature.append((path, False) + _stat_signature(_OS.lstat(path)))
+        if _OS.path.islink(path):
+          hasher.update(_OS.readlink(path).encode('utf-8'))
+        else:
+          with open(path, 'rb') as f:
+            drake.hashing.update(hasher, f)
 
     if self.__hash is None:
       with profile_hashing():
-        hasher = hashlib.sha1()
-        hashable = (
+        hashable = sorted(
           dep for dep in chain((self,), self.dependencies)
           if isinstance(dep, Node))
-        for node in sorted(hashable):
-          _hash_file(hasher, node.path())
+        paths = tuple(str(node.path()) for node in hashable)
+        key = str(self.__name)
+        state = None if Drake.current.paranoid_hash else Drake.current.state
+        if state is not None:
+          cached = state.get('hashes', key)
+          if cached is not None and cached[0] == paths and \
+             _stat_signature_valid(cached[1]):
+            self.__hash = cached[2]
+            return self.__hash
+        start = time.time()
+        hasher = drake.hashing.hasher(Drake.current.hash_algorithm)
+        signature = []
+        for path in paths:
+          _hash_file(hasher, path, signature)
         self.__hash = hasher.digest()
+        # Files modified within the mtime granularity of the hashing
+        # could change again without their metadata changing: do not
+        # trust those.
+        if state is not None and \
+           all(s[-2] < (start - 1) * 1e9 for s in signature):
+          state.set('hashes', key, (paths, tuple(signature), self.__hash))
     return self.__hash
 
   def skippable(self):
@@ -1616,6 +2684,8 @@ class VirtualNode(BaseNode):
   other nodes, but does not directly produce a file.
   """
 
+  __slots__ = ()
+
   def __init__(self, name):
     """Create a virtual node with the given name."""
     path = drake.Drake.current.prefix / name
@@ -1627,6 +2697,13 @@ class Node(BaseNode):
 
   """BaseNode representing a file."""
 
+  __slots__ = (
+    '__exists',
+    '__mtime',
+    '__path',
+    '__path_absolute',
+  )
+
   def __init__(self, path):
     """Construct a Node with the given path."""
     path = drake.Drake.current.prefix / path
@@ -1683,7 +2760,7 @@ class Node(BaseNode):
     Nodes are built if their file does not exist.
     """
     if not self.__exists:
-      self.__exists = self.path().exists()
+      self.__exists = Drake.current.stat_cache.exists(str(self.path()))
     return not self.__exists
 
   def build(self):
@@ -1745,7 +2822,8 @@ class Node(BaseNode):
   @property
   def mtime_local(self):
     if self.__mtime is None:
-      self.__mtime = _OS.lstat(str(self.path())).st_mtime
+      self.__mtime = \
+        Drake.current.stat_cache.lstat(str(self.path())).st_mtime
     return self.__mtime
 
   def touch(self, t):
@@ -1758,6 +2836,7 @@ class Node(BaseNode):
         else:
           raise NotImplementedError()
       _OS.utime(str(self.path()), (t, t), follow_symlinks=False)
+      Drake.current.stat_cache.invalidate(str(self.path()))
       self.__mtime = None
       return self.mtime_local >= t
 
@@ -1802,7 +2881,10 @@ def node(path, type = None):
   if not isinstance(path, Path):
     path = Path(path)
   d = Drake.current
-  res = d.nodes.get((drake.path_build() / path).canonize(), None)
+  name = (drake.path_build() / path).canonize()
+  res = d.nodes.get(name, None)
+  if res is None and d.lazy_load(name):
+    res = d.nodes.get(name, None)
   if res is None:
     if type is not None:
       res = type(path)
@@ -1844,15 +2926,121 @@ def run_command(cmd, cwd = None, env = None, timeout = TIMEOUT,
   if env:
     env = {k: str(v) for k, v in env.items()}
   try:
-    returncode = subprocess.call(cmd,
-                                 cwd = cwd, env = env, timeout = timeout,
-                                 **kwargs)
-    return returncode == 0
+    if isinstance(cmd, list) and set(kwargs) <= {'stdout', 'stderr'} and \
+       drake.sched.coroutine() is not None:
+      if drake.sched.event_loop() is not None:
+        res = drake.sched.wait_async(_run_command_async(
+          cmd, cwd = cwd, env = env, timeout = timeout, **kwargs))
+        if res is not None:
+          return res
+      elif drake.process.supported():
+        return drake.process.reactor().run(
+          cmd, cwd = cwd, env = env, timeout = timeout, **kwargs)
+      # Block a thread rather than other coroutines.
+      return drake.sched.background(lambda: run_command(
+        cmd, cwd = cwd, env = env, timeout = timeout, **kwargs))
+    if not hasattr(_OS, 'wait4') or not hasattr(_OS, 'waitid'):
+      returncode = subprocess.call(cmd,
+                                   cwd = cwd, env = env, timeout = timeout,
+                                   **kwargs)
+      return returncode == 0
+    # Reap the process ourselves to get its peak memory.
+    process = subprocess.Popen(cmd, cwd = cwd, env = env, **kwargs)
+    # Held to reap the process, after which its pid may be reused and
+    # must not be signaled.
+    reaping = threading.Lock()
+    timer = None
+    timed_out = []
+    if timeout is not None:
+      def kill():
+        with reaping:
+          if process.returncode is None:
+            timed_out.append(True)
+            process.kill()
+      timer = threading.Timer(timeout, kill)
+      timer.daemon = True
+      timer.start()
+    try:
+      # Wait for the process to exit, but leave it to reap.
+      _OS.waitid(_OS.P_PID, process.pid, _OS.WEXITED | _OS.WNOWAIT)
+    except BaseException:
+      with reaping:
+        process.kill()
+        process.wait()
+      raise
+    finally:
+      if timer is not None:
+        timer.cancel()
+    with reaping:
+      _, status, usage = _OS.wait4(process.pid, 0)
+      if _OS.WIFSIGNALED(status):
+        process.returncode = -_OS.WTERMSIG(status)
+      else:
+        process.returncode = _OS.WEXITSTATUS(status)
+    if timed_out:
+      raise subprocess.TimeoutExpired(cmd, timeout)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    drake.resources.record(
+      usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024))
+    return process.returncode == 0
   except getattr(__builtins__, 'FileNotFoundError', IOError) as e:
     print(e, file = sys.stderr)
     return False
 
 
+async def _run_command_async(cmd, cwd, env, timeout,
+                             stdout = None, stderr = None):
+  """Run cmd as an asyncio subprocess, or return None if the event
+  loop cannot.
+
+  Output that would go to the terminal is buffered, and written
+  through the console when the command ends.
+  """
+  try:
+    process = await asyncio.create_subprocess_exec(
+      *cmd, cwd = cwd, env = env,
+      stdout = asyncio.subprocess.PIPE if stdout is None else stdout,
+      stderr = asyncio.subprocess.PIPE if stderr is None else stderr)
+  except (NotImplementedError, RuntimeError):
+    # No subprocess support, or child watcher, for this loop.
+    return None
+  output = []
+  async def read(stream, pipe):
+    while True:
+      data = await pipe.read(1 << 16)
+      if not data:
+        return
+      output.append((stream, data))
+  readers = [asyncio.ensure_future(read(stream, pipe))
+             for stream, pipe in (('stdout', process.stdout),
+                                  ('stderr', process.stderr))
+             if pipe is not None]
+  try:
+    try:
+      returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+      process.kill()
+      await process.wait()
+      raise subprocess.TimeoutExpired(cmd, timeout)
+    except BaseException:
+      if process.returncode is None:
+        process.kill()
+      raise
+    # Read the output to the end, unless background children hold
+    # the pipes for too long.
+    if readers:
+      done, pending = await asyncio.wait(
+        readers, timeout = drake.process.GRACE)
+      if pending:
+        logger.log('drake.process', drake.log.LogLevel.log,
+                   'pipes of %s are held by background children', cmd)
+    return returncode == 0
+  finally:
+    for reader in readers:
+      reader.cancel()
+    drake.process.terminal().release(process, output)
+
+
 def command_flatten(command, env = None):
   if env:
     env_ = ['%s=%s' % (var, pipes.quote(str(val)))
@@ -1899,12 +3087,39 @@ class Builder:
 
   """Produces a set of BaseNodes from an other set of BaseNodes."""
 
+  # Like nodes, builders only get a dictionary for attributes
+  # other than these.
+  __slots__ = (
+    '__dict__',
+    '__cachedir',
+    '__create_dirs',
+    '__sources',
+    '__sources_dyn',
+    '__targets',
+    '_uid',
+    '_depfiles',
+    '_depfile',
+    '__depfile_builder',
+    '__state_entries',
+    '__trace_track',
+    '__executed',
+    '__executed_exception',
+    '__executed_signal',
+    '_builder_hash',
+  )
+
   builders = []
+  # The uid of the next builder.
   uid = 0
 
   name = 'build'
   _deps_handlers = {}
 
+  # Whether the targets are a function of the builder hash and the
+  # content of its sources only, and can thus be restored from the
+  # action cache.
+  cacheable = False
+
   class Failed(Exception):
 
     def __init__(self, builder):
@@ -1932,7 +3147,8 @@ class Builder:
     """
     self.__create_dirs = create_directories
     self.__sources = {}
-    self.__sources_dyn = {}
+    # Dynamic sources and depfiles are allocated on demand.
+    self.__sources_dyn = None
     for src in srcs:
       self.add_src(src)
     self.__targets = []
@@ -1941,19 +3157,22 @@ class Builder:
         raise BuilderRedefinition(dst, dst.builder, self)
       self.__targets.append(dst)
       dst.builder = self
-    self.uid = Builder.uid
+    self._uid = Builder.uid
     Builder.uid += 1
     Builder.builders.append(self)
-    self._depfiles = {}
+    self._depfiles = None
     self._depfile = DepFile(self, 'drake')
     self.__depfile_builder = DepFile(self, 'drake.Builder')
+    self.__state_entries = None
+    self.__trace_track = 0
     self.__executed = False
     self.__executed_exception = None
     self.__executed_signal = None
 
   def sources_dynamic(self):
     """The list of dynamic source nodes."""
-    return self.__sources_dyn.values()
+    sources = self.__sources_dyn
+    return sources.values() if sources is not None else ()
 
   def sources(self):
     """The list of source nodes."""
@@ -2049,7 +3268,66 @@ class Builder:
               else:
                 return False
         return True
-    return self._run_job(fun)
+    executor = Drake.current.executor
+    if executor is not None and len(cmd) == 1 and cwd is None:
+      inputs = self.hermetic_inputs()
+      if inputs is not None:
+        res = self.__run_remote(executor, pretty, cmd[0], inputs,
+                                env, out_file, cut_stderr)
+        if res is not None:
+          if not res and throw:
+            raise Exception('command failed: %s' %
+                            command_flatten(cmd[0], env))
+          return res
+    # Commands run from coroutines do not block, no thread is needed.
+    return self._run_job(fun,
+                         blocking = drake.sched.coroutine() is None)
+
+  def watch_directories(self):
+    """Directories where new files may change the dependencies of
+    this builder, watched along with its sources by --watch."""
+    return []
+
+  def hermetic_inputs(self):
+    """The nodes the commands of this builder read, or None.
+
+    Builders that know every file their command reads can have it
+    run by the executor instead of locally.
+    """
+    return None
+
+  def __run_remote(self, executor, pretty, command, inputs,
+                   env, out_file, cut_stderr):
+    """Run command on executor, or return None if it is unable to."""
+    command = [str(e.path()) if isinstance(e, Node) else str(e)
+               for e in command]
+    if not _RAW and pretty is not None:
+      self.output(pretty)
+    else:
+      self.output(command_flatten(command, env))
+    action = drake.executor.Action(
+      command,
+      inputs = [n.path() for n in inputs if isinstance(n, Node)],
+      outputs = [t.path() for t in self.__targets
+                 if isinstance(t, Node)],
+      env = env)
+    try:
+      with log_time(self), self.__trace_job():
+        result = self.__background(lambda: executor.run(action))
+    except Exception as e:
+      drake.warn('unable to execute %s remotely, running locally: %s' %
+                 (self, e))
+      return None
+    output = []
+    if out_file:
+      with open(out_file, 'wb') as f:
+        f.write(result.stdout)
+    elif result.stdout:
+      output.append(('stdout', result.stdout))
+    if not cut_stderr and result.stderr:
+      output.append(('stderr', result.stderr))
+    drake.process.terminal().release(action, output)
+    return result.status == 0
 
   def output(self, raw, pretty = None):
     """Output pretty, or raw if drake is in raw mode."""
@@ -2072,10 +3350,68 @@ class Builder:
                        False, False)
       return Builder.CACHEDIR / rel / path
 
+  def __state(self):
+    """The build state entries of this builder, by name."""
+    if self.__state_entries is None:
+      cachedir = str(self.cachedir)
+      state = Drake.current.state
+      entries = state.get('depfiles', cachedir)
+      if entries is None:
+        entries = _depfiles_legacy(self.cachedir)
+        if entries:
+          state.set('depfiles', cachedir, entries)
+      self.__state_entries = entries
+    return self.__state_entries
+
+  def __state_update(self, name, content):
+    entries = self.__state()
+    if content is None:
+      entries.pop(name, None)
+    else:
+      entries[name] = content
+    Drake.current.state.set('depfiles', str(self.cachedir), entries)
+
   def hash(self):
     """A hash for this builder"""
     return None
 
+  def action_key(self):
+    """A digest identifying this execution of the builder.
+
+    The key covers the builder type and hash, the target names and
+    the name and content of every static and dynamic source. None if
+    the builder is not cacheable or some target is not a file.
+
+    Absolute paths to the build and source directories in the builder
+    hash are neutralized, so different checkouts share keys.
+    """
+    if not self.cacheable or \
+       not all(isinstance(t, Node) for t in self.__targets):
+      return None
+    hasher = hashlib.sha1()
+    description = repr((
+      '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+      self._builder_hash,
+      [str(t.name_absolute()) for t in self.__targets],
+    ))
+    build = str(path_root())
+    source = _OS.path.normpath(_OS.path.join(build, str(path_source())))
+    for path, placeholder in sorted([(build, '<build>'),
+                                     (source, '<source>')],
+                                    key = lambda p: -len(p[0])):
+      description = description.replace(path, placeholder)
+    hasher.update(description.encode('utf-8'))
+    sources = {}
+    sources.update(self.__sources)
+    sources.update((s.name_absolute(), s) for s in self.sources_dynamic())
+    for name in sorted(sources):
+      h = sources[name].hash()
+      if not isinstance(h, bytes):
+        h = repr(h).encode('utf-8')
+      hasher.update(str(name).encode('utf-8'))
+      hasher.update(h)
+    return hasher.hexdigest()
+
   def dependencies(self):
     """Recompute dynamic dependencies list and return them.
 
@@ -2086,15 +3422,30 @@ class Builder:
 
   def depfile(self, name):
     """The depfile for this node for static dependencies."""
-    if name not in self._depfiles:
-      self._depfiles[name] = DepFile(self, name)
-    return self._depfiles[name]
+    if self._depfiles is None:
+      self._depfiles = {}
+    res = self._depfiles.get(name)
+    if res is None:
+      res = self._depfiles[name] = DepFile(self, name)
+    return res
+
+  def __depfiles(self):
+    """The depfiles for dynamic dependencies."""
+    depfiles = self._depfiles
+    return depfiles.values() if depfiles is not None else ()
+
+  def __source_dynamic_add(self, node):
+    if self.__sources_dyn is None:
+      self.__sources_dyn = {}
+    self.__sources_dyn[node.path()] = node
+    if Drake.current is not None:
+      Drake.current._Drake__dependent_add(node, self)
 
   def add_dynsrc(self, name, node, data = None, source = True):
     """Add a dynamic source node."""
     self.depfile(name).register(node, source = source)
     if source:
-      self.__sources_dyn[node.path()] = node
+      self.__source_dynamic_add(node)
 
   def get_type(self, tname):
     """Return the node type with the given name."""
@@ -2138,7 +3489,7 @@ class Builder:
                      '%s: was built, resuming', self)
         # Otherwise, build it ourselves
         else:
-          self.__executed_signal = drake.sched.Signal()
+          self.__executed_signal = drake.sched.Event()
       # If we were already executed, just skip
       if self.__executed:
         if self.__executed_exception is not None:
@@ -2150,7 +3501,12 @@ class Builder:
                          drake.log.LogLevel.trace,
                          '%s: already built in this run', self)
         return
+      trace = contextlib.ExitStack()
       try:
+        if drake.trace.Trace.current is not None:
+          self.__trace_track = trace.enter_context(
+            drake.trace.track('builders'))
+          trace.enter_context(self.__trace('run'))
         # The list of static dependencies is now fixed
         for source in self.__sources.values():
           self._depfile.register(source)
@@ -2162,106 +3518,25 @@ class Builder:
         # Build static dependencies
         with logger.log('drake.Builder',
                         drake.log.LogLevel.debug,
-                        '%s: build static dependencies', self):
-          run_builders = set()
-          with drake.sched.Scope() as scope:
-            for node in self.__sources.values():
-              if node.skippable():
-                continue
-              if node.builder in run_builders and not node.dependencies:
-                continue
-              scope.run(node.build, str(node))
+                        '%s: build static dependencies', self), \
+             self.__trace('static dependencies'):
+          _build_nodes(self.__sources.values())
         # Build dynamic dependencies
         with logger.log('drake.Builder',
                         drake.log.LogLevel.debug,
-                        '%s: build dynamic dependencies', self):
-          run_builders = set()
+                        '%s: build dynamic dependencies', self), \
+             self.__trace('dynamic dependencies'):
           try:
-            with drake.sched.Scope(exception_join = True) as scope:
-              for node in self.__sources_dyn.values():
-                if node.skippable():
-                  continue
-                if node.builder in run_builders and not node.dependencies:
-                  continue
-                scope.run(node.build, str(node))
+            _build_nodes(self.sources_dynamic(), exception_join = True)
           except Exception as e:
             logger.log('drake.Builder',
                        drake.log.LogLevel.trace,
                        '%s: error building dynamic dependency: %s', self, e)
             explain(self, 'some dynamic dependency could not be built: %s' % e)
             execute = True
-        # If any non-virtual target is missing, we must rebuild.
-        mtime_implemented = True
-        oldest_target = None
-        oldest_mtime = None
-        if not execute:
-          for dst in self.__targets:
-            if dst.missing():
-              explain(self, 'target %s is missing' % dst)
-              execute = True
-              break
-            else:
-              try:
-                mtime = dst.mtime_local
-                if oldest_target is None or mtime < oldest_mtime:
-                  oldest_target = dst
-                  oldest_mtime = mtime
-              except NotImplementedError:
-                mtime_implemented = False
-        # Load static dependencies
-        self._depfile.read()
-        if self._depfile._DepFile__invalid:
-          explain(self,
-                  'dependency file %s is invalid' % self._depfile)
-          execute = True
-        if self._depfile.dirty:
-          explain(self, 'previous build failed')
-          execute = True
-        # If a new dependency appeared, we must rebuild.
-        if not execute:
-          for source in self.__sources.values():
-            path = source.name_absolute()
-            if path not in self._depfile.hashes:
-              explain(self, 'of new dependency %s' % path)
-              execute = True
-              break
-        # Check if we are up to date wrt to the builder itself
-        self._builder_hash = self.hash()
-        depfile_builder = self.cachedir / _DEPFILE_BUILDER
-        if not execute:
-          if self._builder_hash is not None:
-            if depfile_builder.exists():
-              try:
-                with open(str(depfile_builder), 'rb') as f:
-                  stored_hash = pickle.Unpickler(f).load()
-              except Exception:
-                explain(self, 'the builder hash is invalid')
-                execute = True
-              if not execute and self._builder_hash != stored_hash:
-                explain(self,
-                        'hash for the builder changed:\n%r\n%r'
-                        % (stored_hash, self._builder_hash))
-                execute = True
-            else:
-              explain(self, 'the builder hash is missing')
-              execute = True
-        # Check if we are up to date wrt all dependencies
-        if not execute:
-          for f in chain((self._depfile,), self._depfiles.values()):
-            res = f.up_to_date(
-              oldest_target, oldest_mtime, mtime_implemented)
-            if not res:
-              execute = True
-          if Drake.current.adjust_mtime and \
-             mtime_implemented and \
-             not execute and \
-             isinstance(res, float):
-            for dst in self.__targets:
-              if dst.mtime_local <= res:
-                if dst.touch(res):
-                  print('Adjust mtime of %s' % dst)
+        execute = self.__needs_execution(execute)
         if execute:
-          self._execute(depfile_builder)
+          self._execute()
         else:
             self.__executed = True
             logger.log('drake.Builder',
@@ -2278,10 +3553,90 @@ class Builder:
                    drake.log.LogLevel.debug,
                    '%s: done', self)
       finally:
+        trace.close()
         self.__executed = True
-        self.__executed_signal.signal()
-
-  def _execute(self, depfile_builder):
+        # Fail waiters right away, so their siblings are terminated.
+        self.__executed_signal.signal(self.__executed_exception)
+
+  def __needs_execution(self, execute):
+    """Whether the targets are out of date, given their sources are
+    built. execute tells whether that is already known."""
+    # If any non-virtual target is missing, we must rebuild.
+    mtime_implemented = True
+    oldest_target = None
+    oldest_mtime = None
+    if not execute:
+      for dst in self.__targets:
+        if dst.missing():
+          explain(self, 'target %s is missing' % dst)
+          execute = True
+          break
+        else:
+          try:
+            mtime = dst.mtime_local
+            if oldest_target is None or mtime < oldest_mtime:
+              oldest_target = dst
+              oldest_mtime = mtime
+          except NotImplementedError:
+            mtime_implemented = False
+      # Unchanged targets kept their former mtime, but are up to
+      # date with the sources modified before their last execution.
+      if oldest_mtime is not None:
+        cutoff = self.__state().get(_DEPFILE_CUTOFF)
+        if cutoff is not None and cutoff > oldest_mtime:
+          oldest_mtime = cutoff
+    # Load static dependencies
+    with self.__trace('depfile read'):
+      self._depfile.read()
+    if self._depfile._DepFile__invalid:
+      explain(self,
+              'dependency file %s is invalid' % self._depfile)
+      execute = True
+    if self._depfile.dirty:
+      explain(self, 'previous build failed')
+      execute = True
+    # If a new dependency appeared, we must rebuild.
+    if not execute:
+      for source in self.__sources.values():
+        path = source.name_absolute()
+        if path not in self._depfile.hashes:
+          explain(self, 'of new dependency %s' % path)
+          execute = True
+          break
+    # Check if we are up to date wrt to the builder itself
+    self._builder_hash = self.hash()
+    if not execute:
+      if self._builder_hash is not None:
+        entries = self.__state()
+        if _DEPFILE_BUILDER in entries:
+          stored_hash = entries[_DEPFILE_BUILDER]
+          if self._builder_hash != stored_hash:
+            explain(self,
+                    'hash for the builder changed:\n%r\n%r'
+                    % (stored_hash, self._builder_hash))
+            execute = True
+        else:
+          explain(self, 'the builder hash is missing')
+          execute = True
+    # Check if we are up to date wrt all dependencies
+    if not execute:
+      with self.__trace('hashing'):
+        for f in chain((self._depfile,), self.__depfiles()):
+          res = f.up_to_date(
+            oldest_target, oldest_mtime, mtime_implemented)
+          if not res:
+            execute = True
+      if Drake.current.adjust_mtime and \
+         mtime_implemented and \
+         not execute and \
+         isinstance(res, float):
+        for dst in self.__targets:
+          if dst.mtime_local <= res:
+            if dst.touch(res):
+              print('Adjust mtime of %s' % dst)
+    return execute
+
+  def _execute(self):
     with contextlib.ExitStack() as ctx:
       if not Drake.current.kill_builders_on_failure:
         ctx.enter_context(drake.sched.NonInterruptible())
@@ -2294,27 +3649,49 @@ class Builder:
                       drake.log.LogLevel.trace,
                       '%s: needs execution', self):
         # Regenerate dynamic dependencies
-        self.__sources_dyn = {}
-        self._depfiles = {}
+        self.__sources_dyn = None
+        self._depfiles = None
         with logger.log('drake.Builder',
                         drake.log.LogLevel.debug,
-                        '%s: recompute dynamic dependencies', self):
+                        '%s: recompute dynamic dependencies', self), \
+             self.__trace('dependencies scan'):
           self.dependencies()
         with logger.log('drake.Builder',
                         drake.log.LogLevel.debug,
                         '%s: build dynamic dependencies', self):
-          for node in self.__sources_dyn.values():
+          for node in self.sources_dynamic():
             # FIXME: parallelize
             node.build()
         self._builder_hash = self.hash()
+        previous = self.__cutoff_prepare()
         try:
           with logger.log('drake.Builder',
                           drake.log.LogLevel.trace,
                           '%s: execute', self):
             self._depfile.dirty = True
-            success = self.execute()
+            cache = Drake.current.action_cache
+            key = self.action_key() if cache is not None else None
+            cached_targets = [(str(t.name_absolute()), t.path())
+                              for t in self.__targets]
+            with self.__trace('cache restore'):
+              restored = key is not None and self.__background(
+                lambda: cache.restore(key, cached_targets))
+            if restored:
+              self.output('Restore %s from cache' %
+                          ', '.join(map(str, self.__targets)))
+              success = True
+            else:
+              start = time.monotonic()
+              with self.__trace('execute'):
+                success = self.execute()
+              if success:
+                Drake.current.state.set('durations', self.__statistics_key,
+                                        time.monotonic() - start)
+            stat_cache = Drake.current.stat_cache
             for dst in self.__targets:
               dst._Node__mtime = None
+              if isinstance(dst, Node):
+                stat_cache.invalidate(str(dst.path()))
             logger.log('drake.Builder',
                        drake.log.LogLevel.trace,
                        '%s: executed', self)
@@ -2339,30 +3716,35 @@ class Builder:
             if dst.missing():
               raise Exception('%s was not created by %s' % (dst, self))
             if isinstance(dst, Node):
-              dst._Node__hash = None
+              dst._BaseNode__hash = None
+        if previous is not None:
+          self.__cutoff(*previous)
+        if key is not None and not restored:
+          self.__background(lambda: cache.store(key, cached_targets))
         # Update depfiles
         with logger.log('drake.Builder',
                         drake.log.LogLevel.debug,
                         '%s: write dependencies file %s',
-                        self, self._depfile):
+                        self, self._depfile), \
+             self.__trace('hashing'):
           self._depfile.update()
         if self._builder_hash is None:
           logger.log('drake.Builder',
                      drake.log.LogLevel.debug,
-                     '%s: remove builder dependency file %s',
-                     self, depfile_builder)
-          depfile_builder.remove()
+                     '%s: remove builder hash', self)
+          self.__state_update(_DEPFILE_BUILDER, None)
         else:
           logger.log('drake.Builder',
                      drake.log.LogLevel.debug,
-                     '%s: write builder dependency file %s',
-                     self, depfile_builder)
-          with open(str(depfile_builder), 'wb') as f:
-            pickle.Pickler(f).dump(self._builder_hash)
+                     '%s: write builder hash', self)
+          # Store a snapshot, the hash may be a mutable structure.
+          self.__state_update(
+            _DEPFILE_BUILDER,
+            pickle.loads(pickle.dumps(self._builder_hash)))
         # FIXME: BUG: remove dynamic dependencies files
         # that are no longer present, otherwise this will
         # be rebuilt forever.
-        for f in self._depfiles.values():
+        for f in self.__depfiles():
           logger.log('drake.Builder',
                      drake.log.LogLevel.debug,
                      '%s: write dependencies file %s',
@@ -2370,31 +3752,66 @@ class Builder:
           f.update()
         self.__executed = True
 
+  def __cutoff_prepare(self):
+    """The time and the digest and mtime of the consumed targets,
+    before execution."""
+    if not Drake.current.early_cutoff or not Drake.current.use_mtime:
+      return None
+    start = time.time()
+    targets = {}
+    for dst in self.__targets:
+      if isinstance(dst, Node) and dst.consumers and not dst.missing():
+        try:
+          targets[dst] = (
+            dst.hash(), _OS.lstat(str(dst.path())).st_mtime_ns)
+        except Exception:
+          pass
+    return start, targets
+
+  def __cutoff(self, start, targets):
+    """Give targets the execution left unchanged their former mtime,
+    so their consumers are not checked against them again."""
+    stat_cache = Drake.current.stat_cache
+    unchanged = False
+    for dst, (digest, mtime) in targets.items():
+      if dst.hash() != digest:
+        continue
+      path = str(dst.path())
+      st = _OS.lstat(path)
+      _OS.utime(path, ns = (st.st_atime_ns, mtime), follow_symlinks = False)
+      stat_cache.invalidate(path)
+      dst._Node__mtime = None
+      unchanged = True
+      logger.log('drake.Builder',
+                 drake.log.LogLevel.debug,
+                 '%s: %s is unchanged', self, dst)
+    if unchanged:
+      self.__state_update(_DEPFILE_CUTOFF, start)
+    elif _DEPFILE_CUTOFF in self.__state():
+      self.__state_update(_DEPFILE_CUTOFF, None)
+
   def __reload_dyndeps(self):
-    cachedir = self.cachedir
-    if _OS.path.exists(str(cachedir)):
-      for f in _OS.listdir(str(cachedir)):
-        if not _OS.path.isfile(str(cachedir / f)):
-          continue
-        if f in ['drake', 'drake.Builder', 'stdout']:
-          continue
-        depfile = self.depfile(f)
-        depfile.read()
-        if depfile._DepFile__invalid:
-          explain(self, 'dependency file %s is invalid' % f)
-          return True
-        handler = self._deps_handlers[f]
-        with logger.log('drake.Builder',
-                        drake.log.LogLevel.dump,
-                        '%s: consider dependencies file %s', self, f):
-          for path, (hash, data) in depfile.hashes.items():
-            if path not in self.__sources and path not in self.__sources_dyn:
-              node = handler(self, path, self.get_type(data), None)
-              if node is not None:
-                logger.log('drake.Builder',
-                           drake.log.LogLevel.dump,
-                           '%s: add %s to sources', self, path)
-                self.__sources_dyn[node.path()] = node
+    for f in list(self.__state()):
+      if f in ['drake', _DEPFILE_BUILDER, _DEPFILE_CUTOFF]:
+        continue
+      depfile = self.depfile(f)
+      depfile.read()
+      if depfile._DepFile__invalid:
+        explain(self, 'dependency file %s is invalid' % f)
+        return True
+      handler = self._deps_handlers[f]
+      with logger.log('drake.Builder',
+                      drake.log.LogLevel.dump,
+                      '%s: consider dependencies file %s', self, f):
+        for path, (hash, data) in depfile.hashes.items():
+          if path not in self.__sources and \
+             path not in (self.__sources_dyn or ()):
+            node = handler(self, path, self.get_type(data), None)
+            if node is not None:
+              logger.log('drake.Builder',
+                         drake.log.LogLevel.dump,
+                         '%s: add %s to sources', self, path)
+              self.__source_dynamic_add(node)
 
   def execute(self):
     """Generate target nodes from source node.
@@ -2415,12 +3832,12 @@ class Builder:
   def add_src(self, src):
     """Add a static source."""
     self.__sources[src._BaseNode__name] = src
-    src.consumers.append(self)
+    src.consumer_add(self)
 
   def all_srcs(self):
     """All sources, recursively."""
     res = []
-    for src in self.__sources.values() + self.__sources_dyn.values():
+    for src in chain(self.__sources.values(), self.sources_dynamic()):
         res.append(src)
         if src.builder is not None:
             res += src.builder.all_srcs()
@@ -2432,19 +3849,84 @@ class Builder:
         return True
     marks[self] = None
 
-    print('  builder_%s [label="%s", shape=rect]' % (self.uid, self.__class__))
+    print('  builder_%s [label="%s", shape=rect]' % (self._uid, self.__class__))
     for node in itertools.chain(self.__sources.values(),
-                                self.__sources_dyn.values()):
+                                self.sources_dynamic()):
         if node.dot(marks):
-            print('  node_%s -> builder_%s' % (node.uid, self.uid))
+            print('  node_%s -> builder_%s' % (node._uid, self._uid))
     return True
 
-  def _run_job(self, job):
-    if Drake.current.jobs_lock is not None:
-      with Drake.current.jobs_lock, log_time(self):
-        return drake.sched.background(job)
+  @property
+  def __statistics_key(self):
+    if self.__targets:
+      return str(self.__targets[0].name_absolute())
+    # Without targets, tell builders apart by what they read.
+    return repr((
+      '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+      sorted(str(s.name_absolute()) for s in self.__sources.values())))
+
+  @property
+  def duration(self):
+    """How long the last successful execution took, in seconds, or
+    None."""
+    return Drake.current.state.get('durations', self.__statistics_key)
+
+  @property
+  def memory(self):
+    """The peak memory of the commands of the last execution, in
+    bytes, or None."""
+    return Drake.current.state.get('memory', self.__statistics_key)
+
+  def __background(self, f):
+    """Run f in a thread if we are scheduled, to not block others."""
+    if _scheduled():
+      return drake.sched.background(f)
+    else:
+      return f()
+
+  def __trace(self, phase):
+    """Record phase on the trace track of this builder."""
+    if drake.trace.Trace.current is None:
+      return drake.log.NOOP
+    return drake.trace.span('builders', self.__trace_track, phase,
+                            'builder', {'builder': str(self)})
+
+  @contextlib.contextmanager
+  def __trace_job(self):
+    """Record a job on a trace track of its own."""
+    if drake.trace.Trace.current is None:
+      yield
     else:
-      with log_time(self):
+      with drake.trace.track('jobs') as track, \
+           drake.trace.span('jobs', track, str(self), 'job'):
+        yield
+
+  def __measured(self, job):
+    """Wrap job to record the peak memory of its commands."""
+    def measured():
+      with drake.resources.measure() as measure:
+        res = job()
+      if measure.rss:
+        Drake.current.state.set('memory', self.__statistics_key,
+                                measure.rss)
+      return res
+    return measured
+
+  def _run_job(self, job, blocking = True):
+    """Run job, in a thread if it is blocking and several jobs may
+    run at once."""
+    job = self.__measured(job)
+    lock = Drake.current.jobs_lock
+    if lock is not None:
+      if isinstance(lock, drake.resources.Limiter):
+        lock = lock.job(self.memory)
+      with lock, log_time(self), self.__trace_job():
+        if blocking:
+          return drake.sched.background(job)
+        else:
+          return job()
+    else:
+      with log_time(self), self.__trace_job():
         return job()
 
   def cleanup_source_directory(self, root_path):
@@ -2896,11 +4378,60 @@ def include(path, drakefile = None, *args, **kwargs):
     if drakefile is None:
         raise Exception('cannot find %s or %s in %s' %
                         (', '.join(names[:-1]), names[-1], path))
+    if Drake.current.lazy_include:
+      return _LazyModule(str(drakefile), *args, **kwargs)
     res = _raw_include(str(drakefile), *args, **kwargs)
     return res
 
 
+class _LazyModule:
+
+  """An included drakefile, evaluated on first use.
+
+  It is evaluated when one of its variables is accessed, or when a
+  node under its directory is looked up.
+  """
+
+  def __init__(self, drakefile, *args, **kwargs):
+    self.__drakefile = drakefile
+    self.__prefix = Drake.current.prefix
+    self.__args = args
+    self.__kwargs = kwargs
+    self.__module = None
+    Drake.current._Drake__lazy.append(self)
+
+  @property
+  def prefix(self):
+    """The directory of the drakefile, relative to the build root."""
+    return self.__prefix
+
+  def __load(self):
+    if self.__module is None:
+      d = Drake.current
+      d._Drake__lazy.remove(self)
+      previous = d.prefix
+      d._Drake__prefix = self.__prefix
+      try:
+        self.__module = _raw_include(self.__drakefile,
+                                     *self.__args, **self.__kwargs)
+      finally:
+        d._Drake__prefix = previous
+    return self.__module
+
+  def __getattr__(self, name):
+    if name.startswith('_LazyModule__'):
+      raise AttributeError(name)
+    return getattr(self.__load(), name)
+
+  def __getitem__(self, name):
+    return self.__load()[name]
+
+  def __contains__(self, key):
+    return key in self.__load()
+
+
 def _raw_include(path, *args, **kwargs):
+  Drake.current._Drake__drakefiles.append(path)
   g = {
     'drake': drake,
   }
@@ -2928,6 +4459,17 @@ def compilation_database(node):
 
 
 _MODES = {}
+_INVALIDATION_HOOKS = []
+
+
+def invalidation_hook_add(hook):
+  """Register a function dropping what is cached about files.
+
+  When drake notices modifications without restarting, as with
+  --watch or --server, hook is called with the modified nodes, or
+  None if any file may have changed.
+  """
+  _INVALIDATION_HOOKS.append(hook)
 
 
 def command_add(name, action):
@@ -2968,10 +4510,12 @@ def _register_commands():
         if not len(nodes):
           nodes = [node for node in Drake.current.nodes.values()
                    if not len(node.consumers)]
-        coroutines = []
-        for node in nodes:
-          coroutines.append(Coroutine(node.build, str(node),
-                                      Drake.current.scheduler))
+        def build():
+          Drake.current._Drake__fast_forward(nodes)
+          for node in nodes:
+            Coroutine(node.build, str(node), Drake.current.scheduler,
+                      priority = node.critical_path)
+        Coroutine(build, 'fast forward', Drake.current.scheduler)
         Drake.current.scheduler.run()
       except Builder.Failed as e:
         print('%s: *** %s' % (sys.argv[0], e))
@@ -3047,6 +4591,10 @@ def help():
 OPTIONS:
 \t--help, -h: print this usage and exit.
 \t--jobs N, -j N: set number of concurrent jobs to N.
+\t--server: keep the configured graph in memory and build for
+\t  subsequent invocations in this directory.
+\t--server-stop: stop the build server.
+\t--watch: build, then rebuild whenever sources are modified.
 ''')
   print('CONFIG:')
   doc = {}
@@ -3110,6 +4658,27 @@ def complete_options():
 _DEFAULTS = []
 
 
+# Environment variables that do not affect the graph, and thus do not
+# invalidate its snapshot.
+_SNAPSHOT_ENVIRON_IGNORE = {
+  '_',
+  'DRAKE_TRACE',
+  'OLDPWD',
+  'PWD',
+  'SHLVL',
+}
+
+
+# Environment variables that do not affect builds either, and may
+# differ between the build server and its clients.
+_SERVER_ENVIRON_IGNORE = _SNAPSHOT_ENVIRON_IGNORE | {
+  'DRAKE_SERVER',
+  'TERM',
+  'COLUMNS',
+  'LINES',
+}
+
+
 def add_default_node(node):
   _DEFAULTS.append(node)
 
@@ -3635,9 +5204,10 @@ class os:
 def reset():
   for node in Drake.current.nodes.values():
     if node.builder is not None:
-      node.builder._Builder__built = False
-      node.builder._Builder__sources_dyn = {}
+      node.builder._Builder__executed = False
+      node.builder._Builder__sources_dyn = None
   Drake.current._Drake__nodes = {}
+  Drake.current._Drake__dependents = None
 
 
 # Configuration
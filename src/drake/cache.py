@@ -0,0 +1,514 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+import hashlib
+import json
+import os
+import pickle
+import requests
+import shutil
+import socketserver
+import tempfile
+import threading
+
+import drake
+
+# Default maximum size of the action cache, in bytes.
+SIZE = 10 * 1024 ** 3
+
+
+class ActionCache:
+
+  """Content-addressed store of builder outputs.
+
+  Builders outputs are stored under an action key that identifies the
+  builder and the content of all its sources (see
+  Builder.action_key). When a builder needs to be executed, its
+  targets are restored from the cache instead if the same action was
+  already executed.
+
+  The cache directory holds two kinds of files:
+  * objects/xx/yyyy: the content of a file, named after its digest,
+    optionally compressed with zstd.
+  * actions/xx/yyyy: for an action key, the digest and permissions of
+    every target, by target name.
+
+  Files are touched when used, and the least recently used ones are
+  evicted when the cache grows bigger than its size limit.
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as d:
+  ...   cache = ActionCache('%s/cache' % d)
+  ...   with open('%s/output' % d, 'w') as f:
+  ...     print('content', file = f)
+  ...   cache.store('key', [('output', '%s/output' % d)])
+  ...   cache.restore('key', [('output', '%s/restored' % d)])
+  ...   with open('%s/restored' % d) as f:
+  ...     print(f.read(), end = '')
+  True
+  content
+  """
+
+  def __init__(self, path, size = None, compress = False):
+    """Create an action cache.
+
+    path     -- The cache directory.
+    size     -- The maximum size of the cache, in bytes.
+    compress -- Whether to compress stored files with zstd; requires
+                the zstandard module.
+    """
+    self.__path = os.path.abspath(str(path))
+    self.__size = SIZE if size is None else size
+    if compress:
+      try:
+        import zstandard
+      except ImportError:
+        raise Exception(
+          'action cache compression requires the zstandard module')
+      self.__zstd = zstandard
+    else:
+      self.__zstd = None
+    self.__lock = threading.Lock()
+    self.__usage = None
+
+  @property
+  def path(self):
+    """The cache directory."""
+    return self.__path
+
+  @property
+  def size(self):
+    """The maximum size of the cache, in bytes."""
+    return self.__size
+
+  def __file(self, kind, digest):
+    return os.path.join(self.__path, kind, digest[:2], digest[2:])
+
+  def __object(self, digest, compressed):
+    return self.__file('objects', digest) + ('.zst' if compressed else '')
+
+  def __write(self, path, write):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok = True)
+    fd, tmp = tempfile.mkstemp(dir = directory)
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        write(f)
+      os.replace(tmp, path)
+    except BaseException:
+      os.remove(tmp)
+      raise
+    return os.stat(path).st_size
+
+  def __copy(self, source, destination, compress, decompress):
+    if compress:
+      self.__zstd.ZstdCompressor().copy_stream(source, destination)
+    elif decompress:
+      self.__zstd.ZstdDecompressor().copy_stream(source, destination)
+    else:
+      shutil.copyfileobj(source, destination)
+
+  def _get(self, key):
+    """The stored targets of the action key, or None."""
+    path = self.__file('actions', key)
+    try:
+      with open(path, 'rb') as f:
+        entry = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return None
+    for digest, mode, compressed in entry.values():
+      if not os.path.exists(self.__object(digest, compressed)):
+        return None
+    return entry
+
+  def restore(self, key, targets):
+    """Restore targets stored under the action key.
+
+    key     -- The action key.
+    targets -- List of (name, path) of the files to restore.
+
+    Return whether the action was found and all targets restored.
+    """
+    entry = self._get(key)
+    if entry is None or set(entry) != set(name for name, _ in targets):
+      return False
+    if any(compressed for _, _, compressed in entry.values()) and \
+       self.__zstd is None:
+      try:
+        import zstandard
+      except ImportError:
+        return False
+      self.__zstd = zstandard
+    try:
+      for name, path in targets:
+        digest, mode, compressed = entry[name]
+        blob = self.__object(digest, compressed)
+        with open(blob, 'rb') as source:
+          self.__write(str(path),
+                       lambda f: self.__copy(source, f, False, compressed))
+        os.chmod(str(path), mode)
+        os.utime(blob)
+      os.utime(self.__file('actions', key))
+    except OSError as e:
+      drake.warn('unable to restore %s from the action cache: %s' % (
+        key, e))
+      return False
+    return True
+
+  def store(self, key, targets):
+    """Store targets under the action key.
+
+    key     -- The action key.
+    targets -- List of (name, path) of the files to store.
+    """
+    try:
+      entry = {}
+      added = 0
+      for name, path in targets:
+        path = str(path)
+        hasher = hashlib.sha1()
+        with open(path, 'rb') as f:
+          while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+              break
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+        compressed = self.__zstd is not None
+        blob = self.__object(digest, compressed)
+        if os.path.exists(blob):
+          os.utime(blob)
+        else:
+          with open(path, 'rb') as source:
+            added += self.__write(
+              blob, lambda f: self.__copy(source, f, compressed, False))
+        entry[name] = (digest, os.stat(path).st_mode & 0o7777, compressed)
+      added += self.__write(self.__file('actions', key),
+                            lambda f: pickle.dump(entry, f))
+    except OSError as e:
+      drake.warn('unable to store %s in the action cache: %s' % (key, e))
+      return
+    self.__account(added)
+
+  def __account(self, added):
+    with self.__lock:
+      if self.__usage is None:
+        self.__usage = sum(size for _, _, size in self.__files())
+      else:
+        self.__usage += added
+      if self.__usage > self.__size:
+        self.__evict()
+
+  def __files(self):
+    for root, dirs, files in os.walk(self.__path):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        yield path, st.st_mtime, st.st_size
+
+  def __evict(self):
+    """Remove least recently used files down to 90% of the size."""
+    files = sorted(self.__files(), key = lambda f: f[1])
+    usage = sum(size for _, _, size in files)
+    target = self.__size * 9 // 10
+    for path, _, size in files:
+      if usage <= target:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      usage -= size
+    self.__usage = usage
+
+
+class RemoteCache:
+
+  """Action cache shared over HTTP.
+
+  The protocol is a plain GET/PUT by digest, similar to the Bazel
+  remote cache:
+  * /ac/KEY: the action entry, a JSON object mapping target names to
+    their digest and permissions.
+  * /cas/DIGEST: the content of a file, checked against its SHA-1
+    digest by both ends.
+
+  Any HTTP server implementing this protocol can be used; Server is a
+  minimal implementation. Network errors are reported once and
+  disable the remote cache for the rest of the run.
+  """
+
+  def __init__(self, url, timeout = 10):
+    """Create a remote cache.
+
+    url     -- The root URL of the cache server.
+    timeout -- Timeout of requests, in seconds.
+    """
+    self.__url = url.rstrip('/')
+    self.__timeout = timeout
+    self.__sessions = threading.local()
+    self.__disabled = False
+
+  @property
+  def url(self):
+    """The root URL of the cache server."""
+    return self.__url
+
+  def __session(self):
+    session = getattr(self.__sessions, 'session', None)
+    if session is None:
+      session = requests.Session()
+      self.__sessions.session = session
+    return session
+
+  def __request(self, method, kind, digest, data = None):
+    if self.__disabled:
+      return None
+    try:
+      return self.__session().request(
+        method, '%s/%s/%s' % (self.__url, kind, digest),
+        data = data, timeout = self.__timeout)
+    except requests.RequestException as e:
+      self.__disabled = True
+      drake.warn('remote cache %s disabled: %s' % (self.__url, e))
+      return None
+
+  def restore(self, key, targets):
+    """Restore targets stored under the action key.
+
+    See ActionCache.restore.
+    """
+    response = self.__request('GET', 'ac', key)
+    if response is None or response.status_code != 200:
+      return False
+    try:
+      entry = json.loads(response.content.decode('utf-8'))
+    except ValueError:
+      return False
+    if not isinstance(entry, dict) or \
+       set(entry) != set(name for name, _ in targets):
+      return False
+    contents = []
+    for name, path in targets:
+      try:
+        digest, mode = entry[name]
+      except (TypeError, ValueError):
+        return False
+      if not isinstance(digest, str) or not isinstance(mode, int):
+        return False
+      response = self.__request('GET', 'cas', digest)
+      if response is None or response.status_code != 200 or \
+         hashlib.sha1(response.content).hexdigest() != digest:
+        return False
+      # Never let the cache set special bits, such as setuid.
+      contents.append((str(path), response.content, mode & 0o777))
+    try:
+      for path, content, mode in contents:
+        # Never leave a partial target that looks up to date.
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path) or '.')
+        try:
+          with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+          os.chmod(tmp, mode)
+          os.replace(tmp, path)
+        except BaseException:
+          os.remove(tmp)
+          raise
+    except OSError as e:
+      drake.warn('unable to restore %s from the remote cache: %s' % (
+        key, e))
+      return False
+    return True
+
+  def store(self, key, targets):
+    """Store targets under the action key.
+
+    See ActionCache.store.
+    """
+    entry = {}
+    for name, path in targets:
+      try:
+        with open(str(path), 'rb') as f:
+          content = f.read()
+        mode = os.stat(str(path)).st_mode & 0o777
+      except OSError as e:
+        drake.warn('unable to store %s in the remote cache: %s' % (key, e))
+        return
+      digest = hashlib.sha1(content).hexdigest()
+      response = self.__request('HEAD', 'cas', digest)
+      if response is None:
+        return
+      if response.status_code != 200:
+        response = self.__request('PUT', 'cas', digest, content)
+        if response is None or response.status_code not in (200, 201, 204):
+          return
+      entry[name] = (digest, mode)
+    self.__request('PUT', 'ac', key,
+                   json.dumps(entry, sort_keys = True).encode('utf-8'))
+
+
+class Caches:
+
+  """A sequence of action caches, from the fastest to the slowest.
+
+  Targets are restored from the first cache that has them, and then
+  stored in the faster ones. Stored targets go to every cache.
+  """
+
+  def __init__(self, caches):
+    self.__caches = list(caches)
+
+  @property
+  def caches(self):
+    return self.__caches
+
+  def restore(self, key, targets):
+    for i, cache in enumerate(self.__caches):
+      if cache.restore(key, targets):
+        for faster in self.__caches[:i]:
+          faster.store(key, targets)
+        return True
+    return False
+
+  def store(self, key, targets):
+    for cache in self.__caches:
+      cache.store(key, targets)
+
+
+class Server:
+
+  """Minimal HTTP server for the RemoteCache protocol.
+
+  Files are stored as-is in a directory, without eviction. This is
+  meant for tests and small setups.
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as d, Server(d) as server:
+  ...   with open('%s/output' % d, 'w') as f:
+  ...     print('content', file = f)
+  ...   cache = RemoteCache(server.url)
+  ...   cache.store('key', [('output', '%s/output' % d)])
+  ...   cache.restore('key', [('output', '%s/restored' % d)])
+  ...   with open('%s/restored' % d) as f:
+  ...     print(f.read(), end = '')
+  True
+  content
+  """
+
+  def __init__(self, path, host = 'localhost', port = 0):
+    """Create a cache server.
+
+    path -- The directory where to store entries.
+    host -- The address to listen on.
+    port -- The port to listen on, 0 to pick any available one.
+    """
+    import http.server
+    self.__path = os.path.abspath(str(path))
+    self.__thread = None
+    root = self.__path
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+      def __file(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] not in ('ac', 'cas') or \
+           not parts[1].isalnum():
+          return None, None
+        return parts, os.path.join(root, parts[0], parts[1][:2], parts[1])
+
+      def __reply(self, code, content = b''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+          self.wfile.write(content)
+
+      def do_GET(self):
+        parts, path = self.__file()
+        if path is None:
+          return self.__reply(400)
+        try:
+          with open(path, 'rb') as f:
+            content = f.read()
+        except OSError:
+          return self.__reply(404)
+        self.__reply(200, content)
+
+      do_HEAD = do_GET
+
+      def do_PUT(self):
+        parts, path = self.__file()
+        if path is None:
+          return self.__reply(400)
+        content = self.rfile.read(int(self.headers['Content-Length']))
+        if parts[0] == 'cas' and \
+           hashlib.sha1(content).hexdigest() != parts[1]:
+          return self.__reply(400)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+          f.write(content)
+        os.replace(tmp, path)
+        self.__reply(201)
+
+      def log_message(self, *args):
+        pass
+
+    # http.server.ThreadingHTTPServer needs Python 3.7.
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+      daemon_threads = True
+
+    self.__server = Server((host, port), Handler)
+
+  @property
+  def url(self):
+    """The root URL of the server."""
+    host, port = self.__server.server_address[:2]
+    return 'http://%s:%s' % (host, port)
+
+  def start(self):
+    """Serve requests in a background thread."""
+    self.__thread = threading.Thread(target = self.__server.serve_forever,
+                                     daemon = True)
+    self.__thread.start()
+
+  def stop(self):
+    """Stop serving requests."""
+    self.__server.shutdown()
+    self.__server.server_close()
+    self.__thread.join()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def serve(self):
+    """Serve requests until interrupted."""
+    try:
+      self.__server.serve_forever()
+    finally:
+      self.__server.server_close()
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(
+    description = 'Serve a drake remote action cache.')
+  parser.add_argument('path', help = 'directory where to store entries')
+  parser.add_argument('--host', default = 'localhost')
+  parser.add_argument('--port', type = int, default = 8080)
+  args = parser.parse_args()
+  server = Server(args.path, host = args.host, port = args.port)
+  print('Serving %s on %s' % (args.path, server.url))
+  server.serve()
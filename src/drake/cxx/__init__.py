@@ -12,9 +12,11 @@ import io
 import os as _OS
 import re
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import time
 
 from typing import Optional, Tuple
 
@@ -1301,6 +1303,54 @@ def inclusion_dependencies(n, toolkit, config):
 __dependencies_includes = {}
 __dependencies_result = {}
 __include_re = re.compile(b'\\s*#\\s*include\\s*(<|")(.*)(>|")')
+# State namespace of the inclusions scanned in previous builds.
+_INCLUDES = 'drake.cxx.includes'
+
+def _dependencies_invalidate(nodes):
+  '''Forget the inclusions of modified files.'''
+  if nodes is None:
+    __dependencies_includes.clear()
+  else:
+    for node in nodes:
+      __dependencies_includes.pop(node.path(), None)
+  __dependencies_result.clear()
+
+drake.invalidation_hook_add(_dependencies_invalidate)
+
+def _includes(path):
+  '''The inclusions of the file at path, as (include, local) pairs.
+
+  They are kept in the build state along with the file modification
+  time and size, so later builds only read files that changed.
+  '''
+  res = __dependencies_includes.get(path, None)
+  if res is not None:
+    return res
+  name = str(path)
+  info = drake.Drake.current.stat_cache.lstat(name)
+  if stat.S_ISLNK(info.st_mode):
+    info = _OS.stat(name)
+  key = (info.st_mtime_ns, info.st_size)
+  state = drake.Drake.current.state
+  cached = state.get(_INCLUDES, name)
+  if cached is not None and cached[0] == key:
+    res = cached[1]
+  else:
+    res = []
+    with open(name, 'rb') as include_file:
+      for line in include_file:
+        line = line.strip()
+        match = __include_re.match(line)
+        if match:
+          include = match.group(2).decode('latin-1')
+          local = match.group(1) == b'"'
+          res.append((include, local))
+    # Files modified within the mtime resolution could change again
+    # unnoticed: only keep the result once they are old enough.
+    if time.time() - info.st_mtime > 2:
+      state.set(_INCLUDES, name, (key, res))
+  __dependencies_includes[path] = res
+  return res
 
 def mkdeps(explored_node, search, marks, cycles_map, owner_map,
            user = True):
@@ -1365,19 +1415,7 @@ def _mkdeps(explored_node, search, marks, cycles_map, owner_map, user = True):
                   'explore dependencies of %s', path):
     cycles = set()
     deps = set()
-    matches = __dependencies_includes.get(path, None)
-    if matches is None:
-      matches = []
-      with open(str(path), 'rb') as include_file:
-        for line in include_file:
-          line = line.strip()
-          match = __include_re.match(line)
-          if match:
-            include = match.group(2).decode('latin-1')
-            local = match.group(1) == b'"'
-            matches.append((include, local))
-      __dependencies_includes[path] = matches
-    for include, local in matches:
+    for include, local in _includes(path):
       if local:
         current_path = explored_node.name_absolute().dirname()
         local_path = ((current_path, True, user),)
@@ -1389,6 +1427,9 @@ def _mkdeps(explored_node, search, marks, cycles_map, owner_map, user = True):
         test = name
         if test_node:
           registered = drake.Drake.current.nodes.get(test, None)
+          # The header may be generated by a lazily included drakefile.
+          if registered is None and drake.Drake.current.lazy_load(test):
+            registered = drake.Drake.current.nodes.get(test, None)
           if registered is not None:
             # Check this is not an old cached dependency from
             # cxx.inclusions. Not sure of myself though.
@@ -1402,7 +1443,7 @@ def _mkdeps(explored_node, search, marks, cycles_map, owner_map, user = True):
         # source path.
         if not found:# or drake.path_source() != Path('.'):
           test = drake.path_source() / test
-          if test.is_file():
+          if drake.Drake.current.stat_cache.is_file(str(test)):
             logger.log('drake.cxx.dependencies',
                        drake.log.LogLevel.debug,
                        'found %s in sources', name)
@@ -1461,6 +1502,11 @@ class _Compiler(Builder):
   def mkdeps(self):
     return {self.src: inclusion_dependencies(self.src, self.config)}
 
+  def watch_directories(self):
+    # New headers may shadow the ones found in further directories.
+    return [drake.path_source() / path
+            for path in self.config.local_include_path]
+
   @property
   def header_dependencies(self):
     return self.__header_dependencies
@@ -1498,6 +1544,7 @@ class Compiler(_Compiler):
 
   name = 'C++ compilation'
   deps = 'drake.cxx.inclusions'
+  cacheable = True
 
   Builder.register_deps_handler(deps, deps_handler)
 
@@ -1513,6 +1560,11 @@ class Compiler(_Compiler):
                                 c = self.__c,
                                 pic = self.pic)
 
+  def hermetic_inputs(self):
+    # The source and every header it includes, as found by
+    # dependencies.
+    return list(chain(self.sources().values(), self.sources_dynamic()))
+
   @property
   def pic(self):
     def pic_rec(node):
@@ -1533,6 +1585,8 @@ class Compiler(_Compiler):
 
 class Linker(Builder):
 
+  cacheable = True
+
   def __init__(self, target, tk, cfg, strip = False):
     self.__target = target
     self.toolkit = tk
@@ -1608,6 +1662,7 @@ class DynLibLinker(Linker):
 class StaticLibLinker(Builder):
 
   name = 'static library archiving'
+  cacheable = True
 
   def dependencies(self):
     for hook in self.toolkit.hook_bin_deps():
@@ -1930,10 +1985,10 @@ def dot_merge(nodes):
 
   def rec(n, d, marks = {}, skip = False):
     if not skip:
-      print('  node_%s [label="%s"]' % (n.uid, n.name()))
+      print('  node_%s [label="%s"]' % (n._uid, n.name()))
     for s in d:
       rec(s, d[s], marks)
-      k = (n.uid, s.uid)
+      k = (n._uid, s._uid)
       if k not in marks:
         marks[k] = None
         print('  node_%s -> node_%s' % k)
@@ -1945,7 +2000,7 @@ def dot_merge(nodes):
   print('  {')
   print('  rank=same')
   for n in deps:
-    print('  node_%s [label="%s"]' % (n.uid, n.name()))
+    print('  node_%s [label="%s"]' % (n._uid, n.name()))
   print('  }')
   for n in deps:
     rec(n, deps[n], marks, True)
@@ -1959,7 +2014,7 @@ def dot_spread(nodes):
     for s in d:
       si = i + 1
       i = rec(s, d[s], si)
-      k = (s.uid, n.uid)
+      k = (s._uid, n._uid)
       print('  node_%s -> node_%s' % (me, si))
     return i
 
@@ -0,0 +1,385 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''Execution of hermetic commands on worker processes.
+
+An action is a command along with the files it reads and writes,
+relative to the build directory. Since all its inputs are known, it
+can run on any worker that has the same toolchain: inputs are shipped
+to the worker, which runs the command in a scratch directory and sends
+the outputs back. Absolute inputs, such as system headers, are not
+shipped and are expected to exist on the worker.
+
+Workers are served with Worker, possibly on other hosts:
+
+  DRAKE_WORKERS_KEY=secret python3 -m drake.executor 0.0.0.0:4242 -j 8
+
+and used through a RemoteExecutor. ProcessExecutor starts workers as
+local processes.
+'''
+
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import drake
+
+
+def _check_authkey(authkey):
+  # Workers unpickle requests and run commands: never let anyone in.
+  if not authkey:
+    raise Exception('workers require a non empty authentication key')
+
+
+class Action:
+
+  """A command and the files it reads and writes."""
+
+  def __init__(self, command, inputs, outputs, env = None):
+    """Create an action.
+
+    command -- The command, as a list of arguments.
+    inputs  -- Paths of the files the command reads.
+    outputs -- Paths of the files the command writes.
+    env     -- Additional environment variables.
+    """
+    self.command = [str(c) for c in command]
+    self.inputs = [str(i) for i in inputs]
+    self.outputs = [str(o) for o in outputs]
+    self.env = dict((k, str(v)) for k, v in (env or {}).items())
+
+  def __repr__(self):
+    return 'Action(%r)' % self.command
+
+
+class Result:
+
+  """The outcome of an action."""
+
+  def __init__(self, status, stdout, stderr):
+    self.status = status
+    self.stdout = stdout
+    self.stderr = stderr
+
+
+class Executor:
+
+  """Interface of action executors."""
+
+  def run(self, action):
+    """Execute action, write its outputs and return its Result.
+
+    Raise if the action could not be executed at all, as opposed to
+    the command failing, in which case the Result status is non-zero.
+    """
+    raise NotImplementedError()
+
+
+def _depth(paths):
+  """How many levels the relative paths go above their root."""
+  res = 0
+  for path in paths:
+    if not os.path.isabs(path):
+      parts = os.path.normpath(path).split(os.sep)
+      res = max(res, parts.count('..'))
+  return res
+
+
+def _execute(request, blobs):
+  """Run a request in a scratch directory, return (result, outputs)."""
+  root = tempfile.mkdtemp(prefix = 'drake-worker-')
+  try:
+    cwd = os.path.join(root, *request['build'])
+    os.makedirs(cwd, exist_ok = True)
+    for path, digest, mode in request['inputs']:
+      path = os.path.normpath(os.path.join(cwd, path))
+      os.makedirs(os.path.dirname(path), exist_ok = True)
+      with open(path, 'wb') as f:
+        f.write(blobs[digest])
+      os.chmod(path, mode)
+    for path in request['outputs']:
+      os.makedirs(os.path.dirname(os.path.join(cwd, path)) or cwd,
+                  exist_ok = True)
+    env = dict(os.environ)
+    env.update(request['env'])
+    try:
+      p = subprocess.run(request['command'], cwd = cwd, env = env,
+                         stdout = subprocess.PIPE,
+                         stderr = subprocess.PIPE)
+      result = Result(p.returncode, p.stdout, p.stderr)
+    except OSError as e:
+      result = Result(127, b'', ('%s\n' % e).encode('utf-8'))
+    outputs = {}
+    if result.status == 0:
+      for path in request['outputs']:
+        with open(os.path.join(cwd, path), 'rb') as f:
+          outputs[path] = f.read()
+    return result, outputs
+  finally:
+    shutil.rmtree(root, ignore_errors = True)
+
+
+class Worker:
+
+  """Serve actions sent by a RemoteExecutor.
+
+  Workers keep the content of the files they receive, up to a given
+  size, so common inputs such as headers are only shipped once.
+  """
+
+  def __init__(self, address, authkey, jobs = None,
+               cache_size = 512 * 1024 ** 2):
+    """Create a worker.
+
+    address    -- The (host, port) to listen on.
+    authkey    -- The key clients must authenticate with, as bytes.
+    jobs       -- The number of actions to run concurrently, defaults
+                  to the number of CPUs.
+    cache_size -- The maximum size of input files kept, in bytes.
+    """
+    _check_authkey(authkey)
+    self.__listener = multiprocessing.connection.Listener(
+      address, authkey = authkey)
+    self.__jobs = jobs or os.cpu_count()
+    self.__slots = threading.Semaphore(self.__jobs)
+    self.__blobs = {}
+    self.__blobs_size = 0
+    self.__cache_size = cache_size
+    self.__lock = threading.Lock()
+
+  @property
+  def address(self):
+    """The (host, port) the worker listens on."""
+    return self.__listener.address
+
+  @property
+  def jobs(self):
+    """The number of actions run concurrently."""
+    return self.__jobs
+
+  def serve(self):
+    """Serve clients until the process is killed."""
+    while True:
+      try:
+        connection = self.__listener.accept()
+      except (OSError, multiprocessing.AuthenticationError):
+        continue
+      threading.Thread(target = self.__serve, args = (connection,),
+                       daemon = True).start()
+
+  def __serve(self, connection):
+    with connection:
+      while True:
+        try:
+          request = connection.recv()
+        except (EOFError, OSError):
+          return
+        # Take the blobs already known now, so they cannot be
+        # forgotten by other requests before the command runs.
+        known = {}
+        missing = []
+        with self.__lock:
+          for _, digest, _ in request['inputs']:
+            content = self.__blobs.get(digest)
+            if content is not None:
+              known[digest] = content
+            else:
+              missing.append(digest)
+        connection.send(missing)
+        blobs = connection.recv() if missing else {}
+        with self.__lock:
+          self.__remember(blobs)
+        blobs.update(known)
+        with self.__slots:
+          result, outputs = _execute(request, blobs)
+        connection.send((result.status, result.stdout, result.stderr,
+                         outputs))
+
+  def __remember(self, blobs):
+    for digest, content in blobs.items():
+      if digest not in self.__blobs:
+        self.__blobs[digest] = content
+        self.__blobs_size += len(content)
+    # Dictionaries are ordered: forget the oldest entries first.
+    while self.__blobs_size > self.__cache_size and self.__blobs:
+      digest = next(iter(self.__blobs))
+      self.__blobs_size -= len(self.__blobs.pop(digest))
+
+
+class RemoteExecutor(Executor):
+
+  """Execute actions on workers.
+
+  Actions are dispatched to the worker with the most free slots.
+  Connections are kept open and reused.
+  """
+
+  def __init__(self, workers, authkey):
+    """Create a remote executor.
+
+    workers -- List of ((host, port), slots) describing the workers
+               and how many actions each runs concurrently.
+    authkey -- The key to authenticate with workers, as bytes.
+    """
+    _check_authkey(authkey)
+    self.__authkey = authkey
+    self.__free = dict((tuple(address), slots)
+                       for address, slots in workers)
+    self.__connections = dict((address, []) for address in self.__free)
+    self.__condition = threading.Condition()
+    self.__executed = 0
+
+  @property
+  def executed(self):
+    """The number of actions executed on workers."""
+    return self.__executed
+
+  def __acquire(self):
+    with self.__condition:
+      while True:
+        address = max(self.__free, key = lambda a: self.__free[a])
+        if self.__free[address] > 0:
+          self.__free[address] -= 1
+          connections = self.__connections[address]
+          return address, connections.pop() if connections else None
+        self.__condition.wait()
+
+  def __release(self, address, connection):
+    with self.__condition:
+      self.__free[address] += 1
+      if connection is not None:
+        self.__connections[address].append(connection)
+      self.__condition.notify()
+
+  def run(self, action):
+    build = os.getcwd().split(os.sep)
+    depth = _depth(action.inputs + action.outputs)
+    request = {
+      'build': build[len(build) - depth:] if depth else [],
+      'command': action.command,
+      'env': action.env,
+      'inputs': [],
+      'outputs': action.outputs,
+    }
+    contents = {}
+    for path in action.inputs:
+      if os.path.isabs(path):
+        continue
+      with open(path, 'rb') as f:
+        content = f.read()
+      digest = hashlib.sha1(content).hexdigest()
+      contents[digest] = content
+      request['inputs'].append((path, digest, os.stat(path).st_mode & 0o777))
+    address, connection = self.__acquire()
+    try:
+      if connection is None:
+        connection = multiprocessing.connection.Client(
+          address, authkey = self.__authkey)
+      connection.send(request)
+      missing = connection.recv()
+      if missing:
+        connection.send(dict((digest, contents[digest])
+                             for digest in missing))
+      status, stdout, stderr, outputs = connection.recv()
+    except BaseException:
+      if connection is not None:
+        connection.close()
+      self.__release(address, None)
+      raise
+    self.__release(address, connection)
+    for path, content in outputs.items():
+      with open(path, 'wb') as f:
+        f.write(content)
+    with self.__condition:
+      self.__executed += 1
+    return Result(status, stdout, stderr)
+
+
+def _serve(pipe, authkey, jobs):
+  worker = Worker(('localhost', 0), authkey, jobs = jobs)
+  pipe.send(worker.address)
+  pipe.close()
+  worker.serve()
+
+
+class ProcessExecutor(RemoteExecutor):
+
+  """Execute actions on workers running as local processes.
+
+  This escapes the GIL and exercises the whole remote execution path,
+  which makes it handy for testing.
+  """
+
+  def __init__(self, processes = None):
+    """Start worker processes.
+
+    processes -- The number of processes, defaults to the number of
+                 CPUs.
+    """
+    processes = processes or os.cpu_count()
+    authkey = os.urandom(16)
+    self.__processes = []
+    workers = []
+    for i in range(processes):
+      parent, child = multiprocessing.Pipe()
+      process = multiprocessing.Process(target = _serve,
+                                        args = (child, authkey, 1),
+                                        daemon = True)
+      process.start()
+      workers.append((parent.recv(), 1))
+      self.__processes.append(process)
+    super().__init__(workers, authkey)
+
+  def stop(self):
+    """Stop the worker processes."""
+    for process in self.__processes:
+      process.terminate()
+      process.join()
+    self.__processes = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+
+def workers(specification):
+  """Parse a comma separated list of HOST:PORT[:SLOTS] workers.
+
+  >>> workers('localhost:4242,build:4242:8')
+  [(('localhost', 4242), 1), (('build', 4242), 8)]
+  """
+  res = []
+  for worker in specification.split(','):
+    parts = worker.strip().split(':')
+    slots = int(parts[2]) if len(parts) > 2 else 1
+    res.append(((parts[0], int(parts[1])), slots))
+  return res
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(
+    description = 'Serve drake actions. The authentication key is read '
+    'from DRAKE_WORKERS_KEY.')
+  parser.add_argument('address', help = 'HOST:PORT to listen on')
+  parser.add_argument('-j', '--jobs', type = int, default = None)
+  args = parser.parse_args()
+  authkey = os.environ.get('DRAKE_WORKERS_KEY', '').encode('utf-8')
+  if not authkey:
+    parser.error('DRAKE_WORKERS_KEY must be set to a non empty key')
+  host, port = args.address.rsplit(':', 1)
+  worker = Worker((host, int(port)), authkey, jobs = args.jobs)
+  print('Serving %s jobs on %s:%s' % ((worker.jobs,) + worker.address))
+  worker.serve()
@@ -0,0 +1,81 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''File digests.
+
+Nodes are hashed with a configurable algorithm, see Drake.hash_algorithm:
+
+  sha1    -- The default.
+  blake2b -- Faster than sha1 on 64-bit machines.
+  xxh3    -- Much faster, not cryptographic; requires the xxhash module.
+  blake3  -- Much faster and multithreaded on large files; requires the
+             blake3 module.
+
+Files are read in big fixed-size chunks into a reused buffer instead
+of being read whole or in small chunks.
+'''
+
+import hashlib
+
+
+ALGORITHMS = ('sha1', 'blake2b', 'xxh3', 'blake3')
+
+# The size of the chunks files are read and hashed by.
+CHUNK = 1024 ** 2
+
+
+def hasher(algorithm):
+  """A new hasher for algorithm.
+
+  >>> hasher('sha1').name
+  'sha1'
+  >>> hasher('md4')
+  Traceback (most recent call last):
+    ...
+  Exception: unknown hash algorithm: md4
+  """
+  if algorithm == 'sha1':
+    return hashlib.sha1()
+  elif algorithm == 'blake2b':
+    return hashlib.blake2b(digest_size = 20)
+  elif algorithm == 'xxh3':
+    try:
+      import xxhash
+    except ImportError:
+      raise Exception('the xxh3 hash algorithm requires the xxhash module')
+    return xxhash.xxh3_128()
+  elif algorithm == 'blake3':
+    try:
+      import blake3
+    except ImportError:
+      raise Exception('the blake3 hash algorithm requires the blake3 module')
+    return blake3.blake3(max_threads = blake3.blake3.AUTO)
+  else:
+    raise Exception('unknown hash algorithm: %s' % algorithm)
+
+
+def update(hasher, f):
+  """Feed the content of the binary file f to hasher.
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryFile() as f:
+  ...   _ = f.write(b'x' * (CHUNK + 1))
+  ...   _ = f.seek(0)
+  ...   h = hasher('sha1')
+  ...   update(h, f)
+  >>> h.hexdigest() == hashlib.sha1(b'x' * (CHUNK + 1)).hexdigest()
+  True
+  """
+  buffer = bytearray(CHUNK)
+  with memoryview(buffer) as view:
+    while True:
+      read = f.readinto(buffer)
+      if not read:
+        break
+      with view[:read] as piece:
+        hasher.update(piece)
@@ -0,0 +1,307 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''Child processes waited for without a thread each.
+
+A single reactor thread reads the output of every running command
+through pipes with a selector, and reaps them once they exit. The
+output of each command is buffered and written at once when it ends,
+so concurrent commands do not interleave on the terminal. A command
+running alone streams it live instead, until it ends.
+'''
+
+import os
+import selectors
+import subprocess
+import sys
+import threading
+import time
+
+import drake.log
+import drake.resources
+import drake.sched
+
+from drake.sched import logger
+
+
+# How often running processes are polled, in seconds.
+POLL = 0.01
+# How long the output of an exited command is still read for, in
+# seconds, when background children it spawned keep its pipes open.
+GRACE = 5
+
+
+def supported():
+  """Whether commands can be waited for by the reactor here."""
+  return os.name == 'posix' and hasattr(os, 'wait4')
+
+
+class Console:
+
+  """The terminal commands write to.
+
+  The output of a command is buffered, and written when it ends. A
+  command that starts writing while running alone streams its output
+  live until it ends; output of commands ending meanwhile is written
+  after.
+  """
+
+  def __init__(self, stdout = None, stderr = None):
+    self.__stdout = stdout
+    self.__stderr = stderr
+    self.__lock = threading.Lock()
+    self.__owner = None
+    self.__pending = []
+
+  def __stream(self, stream):
+    if stream == 'stdout':
+      return self.__stdout or sys.stdout
+    else:
+      return self.__stderr or sys.stderr
+
+  def __write(self, output):
+    for stream, data in output:
+      stream = self.__stream(stream)
+      buffer = getattr(stream, 'buffer', None)
+      if buffer is not None:
+        stream.flush()
+        buffer.write(data)
+      else:
+        stream.write(data.decode(errors = 'replace'))
+      stream.flush()
+
+  def stream(self, job, stream, data, alone):
+    """Write data for job if it streams live, and return whether it
+    did."""
+    with self.__lock:
+      if self.__owner is None and alone and not self.__pending:
+        self.__owner = job
+      if self.__owner is job:
+        self.__write(((stream, data),))
+        return True
+      return False
+
+  def release(self, job, output):
+    """Write the buffered output of job, which ended."""
+    with self.__lock:
+      if self.__owner is job:
+        self.__owner = None
+      if output:
+        self.__pending.append(output)
+      if self.__owner is None:
+        for output in self.__pending:
+          self.__write(output)
+        del self.__pending[:]
+
+
+class Job:
+
+  """A command run by the reactor."""
+
+  def __init__(self, process, pipes, timeout):
+    self.process = process
+    self.pipes = pipes
+    self.deadline = time.monotonic() + timeout \
+                    if timeout is not None else None
+    self.output = []
+    self.rss = 0
+    self.timed_out = False
+    self.signal = drake.sched.Signal()
+    self.scheduler = drake.sched.Scheduler.scheduler()
+
+  def kill(self):
+    if self.process.returncode is None:
+      try:
+        self.process.kill()
+      except ProcessLookupError:
+        pass
+
+
+class Reactor:
+
+  """Wait for commands and read their output from a single thread.
+
+  The thread is started with the first command, and stops once none
+  is running.
+  """
+
+  def __init__(self, console = None):
+    self.__console = console or terminal()
+    self.__lock = threading.Lock()
+    self.__thread = None
+    self.__jobs = set()
+    # Jobs the thread has yet to register pipes of.
+    self.__new = []
+    self.__selector = None
+    self.__wakeup = None
+
+  def run(self, cmd, cwd = None, env = None, timeout = None,
+          stdout = None, stderr = None):
+    """Run cmd from the current coroutine, and return whether it
+    succeeded.
+
+    Output that would go to the terminal, when stdout or stderr are
+    None, goes through the console.
+    """
+    process = subprocess.Popen(
+      cmd, cwd = cwd, env = env,
+      stdout = subprocess.PIPE if stdout is None else stdout,
+      stderr = subprocess.PIPE if stderr is None else stderr)
+    pipes = {}
+    for stream, pipe in (('stdout', process.stdout),
+                         ('stderr', process.stderr)):
+      if pipe is not None:
+        os.set_blocking(pipe.fileno(), False)
+        pipes[pipe] = stream
+    job = Job(process, pipes, timeout)
+    with self.__lock:
+      self.__jobs.add(job)
+      self.__new.append(job)
+      if self.__thread is None:
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeup = os.pipe()
+        os.set_blocking(self.__wakeup[1], False)
+        self.__selector.register(self.__wakeup[0], selectors.EVENT_READ)
+        self.__thread = threading.Thread(
+          target = self.__run, name = 'drake reactor', daemon = True)
+        self.__thread.start()
+      else:
+        try:
+          os.write(self.__wakeup[1], b'\0')
+        except BlockingIOError:
+          # Already woken up.
+          pass
+    try:
+      drake.sched.wait(job.signal)
+    except BaseException:
+      job.kill()
+      raise
+    drake.resources.record(job.rss)
+    if job.timed_out:
+      raise subprocess.TimeoutExpired(cmd, timeout)
+    return process.returncode == 0
+
+  def __run(self):
+    selector = self.__selector
+    while True:
+      with self.__lock:
+        if not self.__jobs:
+          selector.close()
+          for fd in self.__wakeup:
+            os.close(fd)
+          self.__thread = None
+          return
+        new = self.__new
+        self.__new = []
+        jobs = list(self.__jobs)
+      for job in new:
+        for pipe in job.pipes:
+          selector.register(pipe, selectors.EVENT_READ, job)
+      # Processes are polled even while their pipes are open: a
+      # background child may inherit them and outlive the command.
+      now = time.monotonic()
+      timeout = POLL
+      for job in jobs:
+        if job.deadline is not None:
+          timeout = min(timeout, max(job.deadline - now, 0))
+      for key, _ in selector.select(timeout):
+        if key.data is None:
+          os.read(key.fd, 4096)
+          continue
+        self.__read(key.data, key.fileobj)
+      now = time.monotonic()
+      for job in jobs:
+        if self.__reap(job):
+          # Take what is left in the pipes, without waiting for
+          # children still holding them.
+          for pipe in list(job.pipes):
+            while self.__read(job, pipe):
+              pass
+            if pipe in job.pipes:
+              selector.unregister(pipe)
+              pipe.close()
+              del job.pipes[pipe]
+          with self.__lock:
+            self.__jobs.remove(job)
+          self.__console.release(job, job.output)
+          job.scheduler.schedule(job.signal.signal)
+        elif job.deadline is not None and now >= job.deadline:
+          job.timed_out = True
+          job.deadline = None
+          job.kill()
+
+  def __read(self, job, pipe):
+    """Read available output of job from pipe, and return whether
+    there might be more."""
+    try:
+      data = os.read(pipe.fileno(), 1 << 16)
+    except BlockingIOError:
+      return False
+    if data:
+      self.__output(job, job.pipes[pipe], data)
+      return True
+    else:
+      self.__selector.unregister(pipe)
+      pipe.close()
+      del job.pipes[pipe]
+      return False
+
+  def __output(self, job, stream, data):
+    with self.__lock:
+      alone = len(self.__jobs) == 1
+    if job.output or \
+       not self.__console.stream(job, stream, data, alone):
+      job.output.append((stream, data))
+
+  def __reap(self, job):
+    """Collect the status of job if it exited."""
+    process = job.process
+    try:
+      pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+    except ChildProcessError:
+      # Reaped by someone else: its status is lost, do not take it
+      # for a success.
+      if process.returncode is None:
+        logger.log('drake.process', drake.log.LogLevel.log,
+                   'status of %s (pid %s) was lost',
+                   process.args, process.pid)
+        process.returncode = 255
+      return True
+    if pid == 0:
+      return False
+    if os.WIFSIGNALED(status):
+      process.returncode = -os.WTERMSIG(status)
+    else:
+      process.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    job.rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return True
+
+
+_terminal = None
+_reactor = None
+
+
+def terminal():
+  """The console commands run by drake write to.
+
+  Commands run as asyncio subprocesses write through it too, but
+  never stream live.
+  """
+  global _terminal
+  if _terminal is None:
+    _terminal = Console()
+  return _terminal
+
+
+def reactor():
+  """The reactor commands run by drake are waited for by."""
+  global _reactor
+  if _reactor is None:
+    _reactor = Reactor()
+  return _reactor
@@ -0,0 +1,248 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''Machine resources and resource aware job limitation.'''
+
+import collections
+import contextlib
+import greenlet
+import os
+import re
+import threading
+import weakref
+
+import drake.sched
+
+
+CGROUP = '/sys/fs/cgroup'
+MEMINFO = '/proc/meminfo'
+
+
+def _read(path):
+  try:
+    with open(path) as f:
+      return f.read().strip()
+  except (IOError, OSError):
+    return None
+
+
+def cpu_count(cgroup = CGROUP):
+  """The number of CPUs available, honoring affinity and cgroup quotas.
+
+  cgroup -- The cgroup file system mount point.
+  """
+  if hasattr(os, 'sched_getaffinity'):
+    res = len(os.sched_getaffinity(0))
+  else:
+    res = os.cpu_count() or 1
+  quota = period = None
+  # cgroup v2: "QUOTA PERIOD", QUOTA being "max" when unlimited.
+  v2 = _read(os.path.join(cgroup, 'cpu.max'))
+  if v2 is not None:
+    fields = v2.split()
+    if len(fields) == 2 and fields[0] != 'max':
+      quota, period = int(fields[0]), int(fields[1])
+  else:
+    v1 = _read(os.path.join(cgroup, 'cpu', 'cpu.cfs_quota_us'))
+    if v1 is not None and int(v1) > 0:
+      quota = int(v1)
+      period = int(_read(os.path.join(cgroup, 'cpu', 'cpu.cfs_period_us')))
+  if quota is not None and period:
+    res = min(res, max(1, -(-quota // period)))
+  return res
+
+
+def memory_available(cgroup = CGROUP, meminfo = MEMINFO):
+  """The memory available for new processes in bytes, or None.
+
+  This is the smallest of the system available memory and what
+  remains below the cgroup memory limit.
+
+  cgroup  -- The cgroup file system mount point.
+  meminfo -- The path to the meminfo file.
+  """
+  res = None
+  content = _read(meminfo)
+  if content is not None:
+    match = re.search(r'^MemAvailable:\s+(\d+) kB', content, re.MULTILINE)
+    if match:
+      res = int(match.group(1)) * 1024
+  for limit, usage in [('memory.max', 'memory.current'),
+                       ('memory/memory.limit_in_bytes',
+                        'memory/memory.usage_in_bytes')]:
+    limit = _read(os.path.join(cgroup, limit))
+    if limit is None:
+      continue
+    usage = _read(os.path.join(cgroup, usage))
+    # cgroup v1 reports unlimited as a huge number.
+    if limit != 'max' and int(limit) < 2 ** 60 and usage is not None:
+      remaining = max(0, int(limit) - int(usage))
+      res = remaining if res is None else min(res, remaining)
+    break
+  return res
+
+
+def load():
+  """The one minute load average, or None."""
+  try:
+    return os.getloadavg()[0]
+  except (AttributeError, OSError):
+    return None
+
+
+def size(s):
+  """Parse a size in bytes with an optional K, M, G or T suffix.
+
+  >>> size('512')
+  512
+  >>> size('4G')
+  4294967296
+  >>> size('1.5k')
+  1536
+  """
+  s = str(s).strip()
+  units = 'KMGT'
+  if s and s[-1].upper() in units:
+    return int(float(s[:-1]) * 1024 ** (units.index(s[-1].upper()) + 1))
+  return int(s)
+
+
+class Measure:
+
+  """Peak resident memory of the commands run by a job."""
+
+  def __init__(self):
+    self.rss = 0
+
+
+# Per greenlet, that is per coroutine or per thread.
+_measures = weakref.WeakKeyDictionary()
+
+
+@contextlib.contextmanager
+def measure():
+  """Measure the peak memory of commands run by this coroutine, or
+  this thread."""
+  current = greenlet.getcurrent()
+  previous = _measures.get(current)
+  res = _measures[current] = Measure()
+  try:
+    yield res
+  finally:
+    if previous is None:
+      del _measures[current]
+    else:
+      _measures[current] = previous
+
+
+def record(rss):
+  """Record the peak memory of a command, in bytes."""
+  current = _measures.get(greenlet.getcurrent())
+  if current is not None:
+    current.rss = max(current.rss, rss)
+
+
+class Limiter:
+
+  """Admit jobs when the machine has the resources to run them.
+
+  A job is admitted if less than jobs are running and, when set, if
+  the load average is below max_load and its expected memory fits
+  both in the available memory and, along with the running jobs,
+  below max_memory. A job is always admitted when none is running, so
+  the build progresses no matter what. Resources are reevaluated
+  whenever a job finishes; jobs are admitted in the order they
+  arrived.
+  """
+
+  def __init__(self, jobs = None, max_memory = None, max_load = None,
+               cgroup = CGROUP, meminfo = MEMINFO):
+    """Create a limiter.
+
+    jobs       -- The maximum number of concurrent jobs, defaults to
+                  the number of available CPUs.
+    max_memory -- The maximum expected memory of concurrent jobs, in
+                  bytes.
+    max_load   -- The load average above which no job is started.
+    """
+    self.__jobs = jobs or cpu_count(cgroup)
+    self.__max_memory = max_memory
+    self.__max_load = max_load
+    self.__cgroup = cgroup
+    self.__meminfo = meminfo
+    # Admitted jobs and their expected memory.
+    self.__running = {}
+    self.__waiting = collections.deque()
+
+  @property
+  def jobs(self):
+    """The maximum number of concurrent jobs."""
+    return self.__jobs
+
+  @property
+  def running(self):
+    """The number of running jobs."""
+    return len(self.__running)
+
+  def __str__(self):
+    return 'Limiter(%s)' % self.__jobs
+
+  def __admit(self, memory):
+    if not self.__running:
+      return True
+    if len(self.__running) >= self.__jobs:
+      return False
+    if self.__max_load is not None:
+      current = load()
+      if current is not None and current >= self.__max_load:
+        return False
+    if memory:
+      available = memory_available(self.__cgroup, self.__meminfo)
+      if self.__max_memory is not None:
+        budget = self.__max_memory - sum(self.__running.values())
+        available = budget if available is None else min(available, budget)
+      if available is not None and memory > available:
+        return False
+    return True
+
+  def __admit_waiting(self):
+    while self.__waiting and self.__admit(self.__waiting[0]['memory']):
+      job = self.__waiting.popleft()
+      job['token'] = object()
+      self.__running[job['token']] = job['memory']
+      job['signal'].signal()
+
+  @contextlib.contextmanager
+  def job(self, memory = None):
+    """Run the enclosed code as a job.
+
+    memory -- The expected peak memory of the job in bytes, if known.
+    """
+    memory = memory or 0
+    if not self.__waiting and self.__admit(memory):
+      token = object()
+      self.__running[token] = memory
+    else:
+      job = {'memory': memory, 'signal': drake.sched.Signal(),
+             'token': None}
+      self.__waiting.append(job)
+      try:
+        drake.sched.wait(job['signal'])
+      except BaseException:
+        if job['token'] is None:
+          self.__waiting.remove(job)
+        else:
+          del self.__running[job['token']]
+          self.__admit_waiting()
+        raise
+      token = job['token']
+    try:
+      yield
+    finally:
+      del self.__running[token]
+      self.__admit_waiting()
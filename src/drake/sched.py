@@ -6,8 +6,10 @@
 #
 # See the LICENSE file for more information.
 
+import asyncio
 import collections
 import greenlet
+import heapq
 import os
 import sys
 import threading
@@ -17,6 +19,7 @@ import types
 
 import drake.debug
 import drake.threadpool
+import drake.trace
 import drake.log
 
 
@@ -49,6 +52,10 @@ if 'DRAKE_LOG_LEVEL' in os.environ:
 logger = drake.log.Logger(configuration_string = conf,
                           indentation = Indentation())
 
+# The loop of the calling asyncio coroutine. get_event_loop returns it
+# too, but is deprecated there from Python 3.7, which added this.
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
 class Frozen:
   pass
 
@@ -90,6 +97,7 @@ class Scope:
     self.__coroutine = Coroutine.current
     self.__scheduler = self.__coroutine.scheduler
     self.__coroutines = []
+    self.__waited = []
     return self
 
   def __exit__(self, type, value, traceback):
@@ -102,7 +110,7 @@ class Scope:
       else:
         while True:
           try:
-            self.__coroutine.wait(self.__coroutines)
+            self.__coroutine.wait(self.__coroutines + self.__waited)
             break
           except Exception as e:
             exception = e
@@ -115,11 +123,18 @@ class Scope:
     finally:
       del Scope.__scopes[Coroutine.current][-1]
 
-  def run(self, routine, name):
+  def run(self, routine, name, priority = None):
     coro = Coroutine(routine, name, self.__scheduler,
-                     parent = self.__coroutine)
+                     parent = self.__coroutine, priority = priority)
     self.__coroutines.append(coro)
 
+  def wait(self, waitable):
+    """Wait for waitable on exit too, without starting a coroutine.
+
+    It is not terminated along with the scope coroutines.
+    """
+    self.__waited.append(waitable)
+
   def terminate(self):
     for coro in self.__coroutines:
       coro.terminate()
@@ -135,7 +150,9 @@ from orderedset import OrderedSet
 
 class SchedulingPolicy:
 
-  pass
+  def throw(self, coroutine):
+    """Notify that an exception is pending on an active coroutine."""
+    pass
 
 class RoundRobin(SchedulingPolicy):
 
@@ -165,42 +182,125 @@ class RoundRobin(SchedulingPolicy):
 
 class DepthFirst(SchedulingPolicy):
 
+  """Run the first coroutine in depth first order: children before
+  their parent, and siblings in the order they were added. Coroutines
+  with a pending exception run before their children, to handle it
+  right away.
+
+  Coroutines are kept in a heap ordered by their position in the
+  hierarchy, so picking the next one does not walk the whole tree.
+  """
+
+  # Position of a coroutine after, or before, its children.
+  __AFTER = float('inf')
+  __BEFORE = -1
+
   def __init__(self):
-    self.__coroutines = OrderedSet()
-    self.__hierarchy = {}
+    self.__heap = []
+    # Coroutine -> sequence numbers of its ancestors and itself.
+    self.__paths = {}
+    # Active coroutine -> sequence number of its valid heap entry.
+    # Entries of removed or frozen coroutines are dropped lazily.
+    self.__active = {}
+    self.__sequence = 0
 
   @property
   def busy(self):
-    return bool(self.__coroutines)
+    return bool(self.__active)
+
+  def __push(self, coroutine):
+    self.__sequence += 1
+    self.__active[coroutine] = self.__sequence
+    path = self.__paths[coroutine]
+    heapq.heappush(self.__heap,
+                   (path + (DepthFirst.__AFTER,), self.__sequence, coroutine))
+    if coroutine.exception is not None:
+      self.throw(coroutine)
 
   def add(self, coroutine):
-    parent = coroutine.parent
-    self.__coroutines.add(coroutine)
-    self.__hierarchy.setdefault(parent, OrderedSet()).add(coroutine)
+    self.__sequence += 1
+    self.__paths[coroutine] = \
+      self.__paths.get(coroutine.parent, ()) + (self.__sequence,)
+    self.__push(coroutine)
 
   def remove(self, coroutine):
-    self.__coroutines.remove(coroutine)
-    self.__hierarchy.get(coroutine.parent).remove(coroutine)
+    self.__active.pop(coroutine, None)
+    self.__paths.pop(coroutine, None)
 
   def freeze(self, coroutine):
-    self.__coroutines.remove(coroutine)
+    del self.__active[coroutine]
 
   def unfreeze(self, coroutine):
-    self.__coroutines.add(coroutine)
+    self.__push(coroutine)
+
+  def throw(self, coroutine):
+    if coroutine in self.__active:
+      # Valid as long as the exception is pending.
+      self.__sequence += 1
+      heapq.heappush(
+        self.__heap,
+        (self.__paths[coroutine] + (DepthFirst.__BEFORE,), self.__sequence,
+         coroutine))
 
   def round(self):
-    return (self.__round(self.__hierarchy.get(None, ())),)
-
-  def __round(self, coroutines):
-    for coroutine in coroutines:
-      active = coroutine in self.__coroutines
-      if active and coroutine.exception:
-        return coroutine
-      sub = self.__round(self.__hierarchy.get(coroutine, ()))
-      if sub is not None:
-        return sub
-      if active:
-        return coroutine
+    while self.__heap:
+      position, sequence, coroutine = self.__heap[0]
+      if position[-1] == DepthFirst.__BEFORE:
+        if coroutine in self.__active and coroutine.exception is not None:
+          return (coroutine,)
+      elif self.__active.get(coroutine) == sequence:
+        return (coroutine,)
+      heapq.heappop(self.__heap)
+    return ()
+
+
+class CriticalPath(SchedulingPolicy):
+
+  """Run the coroutine with the highest priority first.
+
+  Priorities are meant to be the length of the longest chain of work
+  that remains once the coroutine is done, so that long chains start
+  early. Coroutines of equal priority run in the order they were
+  added.
+  """
+
+  def __init__(self):
+    self.__heap = []
+    # Active coroutine -> sequence number of its valid heap entry.
+    # Entries of removed or frozen coroutines are dropped lazily.
+    self.__active = {}
+    self.__sequence = 0
+
+  @property
+  def busy(self):
+    return bool(self.__active)
+
+  def __push(self, coroutine):
+    self.__sequence += 1
+    self.__active[coroutine] = self.__sequence
+    heapq.heappush(self.__heap,
+                   (-coroutine.priority, self.__sequence, coroutine))
+
+  def add(self, coroutine):
+    self.__push(coroutine)
+
+  def remove(self, coroutine):
+    self.__active.pop(coroutine, None)
+
+  def freeze(self, coroutine):
+    del self.__active[coroutine]
+
+  def unfreeze(self, coroutine):
+    self.__push(coroutine)
+
+  def round(self):
+    while self.__heap:
+      _, sequence, coroutine = self.__heap[0]
+      if self.__active.get(coroutine) == sequence:
+        return (coroutine,)
+      heapq.heappop(self.__heap)
+    return ()
+
 
 class Scheduler:
 
@@ -214,9 +314,15 @@ class Scheduler:
   def __init__(self, jobs = None, policy = None):
     self.reset()
     Scheduler.__instance = self
+    self.__jobs = jobs or 1
     self.__lock = threading.Condition()
     self.__policy = policy or RoundRobin()
     self.__scheduled = []
+    self.__statistics = None
+    self.__processes = None
+    self.__loop = None
+    self.__wakeup = None
+    self.__thread = None
 
   def __str__(self):
     return 'Scheduler'
@@ -230,6 +336,34 @@ class Scheduler:
   def running(self):
     return self.__running
 
+  @property
+  def jobs(self):
+    """The number of concurrent jobs the thread pool is sized for."""
+    return self.__jobs
+
+  @jobs.setter
+  def jobs(self, jobs):
+    self.__jobs = jobs
+
+  @property
+  def statistics(self):
+    """Counters of the current or last thread pool, or None."""
+    if Scheduler.__pool is not None:
+      return Scheduler.__pool.statistics()
+    return self.__statistics
+
+  @property
+  def loop(self):
+    """The event loop run_async runs on, or None."""
+    return self.__loop
+
+  @property
+  def process_pool(self):
+    """The pool background_process runs functions in."""
+    if self.__processes is None:
+      self.__processes = drake.threadpool.ProcessPool(self.__jobs)
+    return self.__processes
+
   def debug(self, msg):
     return logger.log('drake.scheduler', drake.log.LogLevel.trace, msg)
 
@@ -238,14 +372,53 @@ class Scheduler:
     self.__policy.add(coro)
 
   def run(self):
+    """Run coroutines until they are all done."""
+    for idle in self.__run():
+      if idle:
+        with self.__lock:
+          if not self.__scheduled:
+            self.__lock.wait()
+
+  async def run_async(self):
+    """Run coroutines until they are all done, from the current
+    asyncio event loop.
+
+    The loop keeps running other tasks meanwhile, and coroutines can
+    wait for asyncio tasks on it with wait_async.
+    """
+    self.__loop = _running_loop()
+    self.__wakeup = asyncio.Event()
+    try:
+      for idle in self.__run():
+        if idle:
+          await self.__wakeup.wait()
+          self.__wakeup.clear()
+        else:
+          await asyncio.sleep(0)
+    finally:
+      self.__loop = None
+      self.__wakeup = None
+
+  # Steps between which run_async lets other tasks run.
+  ASYNC_STEPS = 64
+
+  def __run(self):
+    """Step coroutines, yielding True when waiting for threads to
+    schedule something, and False from time to time otherwise."""
 
     assert not self.__running
 
     self.__running = True
+    self.__thread = threading.current_thread()
     self.die = False
-    Scheduler.__pool = drake.threadpool.ThreadPool()
+    # Jobs only hold a thread while they run a command or some other
+    # blocking operation: size the pool for the number of concurrent
+    # jobs, with some room for hashing and cache operations.
+    Scheduler.__pool = drake.threadpool.ThreadPool(
+      max(self.__jobs, os.cpu_count() or 1))
 
     try:
+      steps = 0
       while True:
         if self.__exception is not None:
           self.debug('%s: pending exception %s, dying' % \
@@ -261,22 +434,35 @@ class Scheduler:
           else:
             while not self.__policy.busy:
               with self.__lock:
-                if not self.__scheduled:
-                  self.__lock.wait()
-                assert self.__scheduled
-                for f in self.__scheduled:
-                  f()
+                scheduled = self.__scheduled
                 self.__scheduled = []
+              if not scheduled:
+                yield True
+              for f in scheduled:
+                f()
         for coro in self.__policy.round():
           assert coro is not None
-          with self.__lock:
-            for f in self.__scheduled:
+          # Only take the lock if threads scheduled something, not to
+          # contend with them on every step.
+          if self.__scheduled:
+            with self.__lock:
+              scheduled = self.__scheduled
+              self.__scheduled = []
+            for f in scheduled:
               f()
-            self.__scheduled = []
           self.__step(coro)
+          steps += 1
+          if steps % Scheduler.ASYNC_STEPS == 0:
+            yield False
     finally:
       Scheduler.__pool.stop()
+      self.__statistics = Scheduler.__pool.statistics()
+      if 'DRAKE_PROFILE' in os.environ:
+        print('thread pool: %s' % Scheduler.__pool)
       Scheduler.__pool = None
+      if self.__processes is not None:
+        self.__processes.stop()
+        self.__processes = None
       self.__running = False
 
   def __step(self, coro):
@@ -309,6 +495,8 @@ class Scheduler:
     with self.__lock:
       self.__scheduled.append(f)
       self.__lock.notify()
+      if self.__loop is not None:
+        self.__loop.call_soon_threadsafe(self.__wakeup.set)
 
 class Waitable:
   def __init__(self):
@@ -339,8 +527,27 @@ class Waitable:
 
 class Signal(Waitable):
 
-  def signal(self):
-    self._Waitable__wake_all()
+  def signal(self, exception = None):
+    """Wake waiting coroutines, raising exception in them if any."""
+    self._Waitable__wake_all(exception)
+
+class Event(Signal):
+
+  """A signal that stays set: waiting on it once signaled returns
+  right away."""
+
+  def __init__(self):
+    super().__init__()
+    self.__set = False
+
+  def signal(self, exception = None):
+    self.__set = True
+    super().signal(exception)
+
+  def _Waitable__wait(self, coro):
+    if self.__set:
+      return False
+    return Waitable._Waitable__wait(self, coro)
 
 class classproperty:
   def __init__(self, f):
@@ -352,8 +559,10 @@ class Coroutine(Waitable):
 
   __current = None
 
-  def __init__(self, routine, name, scheduler = None, parent = None):
+  def __init__(self, routine, name, scheduler = None, parent = None,
+               priority = None):
     Waitable.__init__(self)
+    self.__priority = priority
     self.__coro = greenlet.greenlet(routine)
     self.__done = False
     self.__done_hooks = []
@@ -379,6 +588,8 @@ class Coroutine(Waitable):
       for waited in self.__waited:
         waited._Waitable__unwait(self)
       self.__waited.clear()
+    elif self.__scheduler is not None and not self.done:
+      self.__scheduler._Scheduler__policy.throw(self)
 
   @property
   def parent(self):
@@ -392,6 +603,19 @@ class Coroutine(Waitable):
   def name(self):
     return self.__name
 
+  @property
+  def priority(self):
+    """The scheduling priority, inherited from the parent if unset.
+
+    It may be given as a callable, evaluated on first access.
+    """
+    if callable(self.__priority):
+      self.__priority = self.__priority()
+    if self.__priority is None:
+      self.__priority = \
+        self.__parent.priority if self.__parent is not None else 0
+    return self.__priority
+
   @property
   def frozen(self):
     """Whether this coroutine is frozen."""
@@ -447,6 +671,9 @@ class Coroutine(Waitable):
                    '%s: block on %s', self, self.__waited)
         if freeze:
           self.__frozen = True
+          if drake.trace.Trace.current is not None:
+            drake.trace.instant('scheduler', 0, 'freeze', 'scheduler',
+                                {'coroutine': self.name})
           if self.current:
             coro_yield(handle_exceptions = handle_exceptions)
 
@@ -510,6 +737,9 @@ class Coroutine(Waitable):
   def __unfreeze(self):
     assert self.frozen
     self.__frozen = False
+    if drake.trace.Trace.current is not None:
+      drake.trace.instant('scheduler', 0, 'unfreeze', 'scheduler',
+                          {'coroutine': self.name})
     if self.__scheduler:
       self.__scheduler.unfreeze(self)
 
@@ -611,6 +841,77 @@ def background(f):
   else:
     return op.result
 
+def background_process(f, *args):
+  """Run f(*args) in a worker process and return its result.
+
+  Like background, but escapes the GIL for Python heavy work. f and
+  args must be picklable, and f must not rely on the drake state of
+  the calling process.
+  """
+  scheduler = Scheduler.scheduler()
+  signal = Signal()
+  result = []
+  def done(future):
+    result.append(future)
+    scheduler.schedule(signal.signal)
+  scheduler.process_pool.run(f, args, done)
+  wait(signal)
+  return result[0].result()
+
+def coroutine():
+  """The current coroutine, or None if there is none or when called
+  from a thread it runs blocking operations in."""
+  scheduler = Scheduler.scheduler()
+  if scheduler is None or \
+     scheduler._Scheduler__thread is not threading.current_thread():
+    return None
+  return Coroutine.current
+
+def event_loop():
+  """The event loop the current coroutine runs on, or None if its
+  scheduler was not started with run_async."""
+  if coroutine() is None:
+    return None
+  loop = Scheduler.scheduler().loop
+  if loop is None:
+    return None
+  try:
+    # Threads of the pool do not run on it.
+    if _running_loop() is not loop:
+      return None
+  except RuntimeError:
+    return None
+  return loop
+
+def wait_async(awaitable):
+  """Run awaitable and return its result, without blocking other
+  coroutines.
+
+  It runs on the event loop of the scheduler if it was started with
+  run_async, otherwise on an event loop of its own in a thread.
+  """
+  loop = event_loop()
+  if loop is None:
+    def run():
+      loop = asyncio.new_event_loop()
+      try:
+        return loop.run_until_complete(awaitable)
+      finally:
+        loop.close()
+    if Coroutine.current is None:
+      return run()
+    return background(run)
+  scheduler = Scheduler.scheduler()
+  signal = Signal()
+  future = asyncio.ensure_future(awaitable, loop = loop)
+  future.add_done_callback(lambda f: scheduler.schedule(signal.signal))
+  try:
+    wait(signal)
+  except BaseException:
+    future.cancel()
+    raise
+  return future.result()
+
 class Lockable:
 
   def lock(self):
@@ -0,0 +1,266 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''Build server keeping the configured graph in memory.
+
+A server is started with `drake --server`: it configures the graph
+once and then builds what clients request, keeping the nodes, path
+caches, build state and toolkit probes between builds. Any other
+drake invocation in the same build directory becomes a client: it
+sends its command line and environment, along with its standard
+output and error file descriptors so commands write directly to the
+client terminal, and exits with the build status.
+
+The protocol is one JSON message per line over a Unix socket: the
+server greets with its pid, the client sends its request and the
+server replies with one of:
+
+  {"status": STATUS}  -- The build ran, with the given exit status.
+  {"local": REASON}   -- The server cannot serve this request, for
+                         instance because the environment differs;
+                         the client builds by itself.
+  {"reload": REASON}  -- The drakefiles changed: the server restarts
+                         and the client retries once it is back.
+'''
+
+import array
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+
+# The command line the server was started with, before drake scripts
+# strip their own arguments, to restart it.
+ARGV = list(sys.argv)
+
+_FDS_MAX = 8
+
+
+class Channel:
+
+  """JSON messages and file descriptors over a Unix socket."""
+
+  def __init__(self, socket):
+    self.__socket = socket
+    self.__buffer = b''
+    self.fds = []
+
+  def send(self, message, fds = ()):
+    """Send a message, along with the given file descriptors."""
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    ancillary = []
+    if fds:
+      ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                        array.array('i', fds)))
+    sent = self.__socket.sendmsg([data], ancillary)
+    if sent < len(data):
+      self.__socket.sendall(data[sent:])
+
+  def recv(self):
+    """Receive a message, collecting file descriptors in fds."""
+    fds = array.array('i')
+    while b'\n' not in self.__buffer:
+      data, ancillary, _, _ = self.__socket.recvmsg(
+        65536, socket.CMSG_SPACE(_FDS_MAX * fds.itemsize))
+      for level, kind, content in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+          content = content[:len(content) - len(content) % fds.itemsize]
+          fds.frombytes(content)
+      if not data:
+        raise EOFError('connection closed')
+      self.__buffer += data
+    self.fds.extend(fds)
+    line, self.__buffer = self.__buffer.split(b'\n', 1)
+    return json.loads(line.decode('utf-8'))
+
+
+class Server:
+
+  """Serve build requests one at a time on a Unix socket."""
+
+  def __init__(self, path, handler):
+    """Create a server.
+
+    path    -- The path of the socket.
+    handler -- Called with the client argv and environment, while the
+               standard output and error are the client ones, and
+               returning the reply.
+    """
+    self.__path = str(path)
+    self.__handler = handler
+    self.__socket = None
+
+  @property
+  def path(self):
+    """The path of the socket."""
+    return self.__path
+
+  def __listen(self):
+    if os.path.exists(self.__path):
+      if _connect(self.__path) is not None:
+        raise Exception('a server is already running on %s' % self.__path)
+      os.remove(self.__path)
+    os.makedirs(os.path.dirname(self.__path) or '.', exist_ok = True)
+    self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.__socket.bind(self.__path)
+    self.__socket.listen(16)
+
+  def __close(self):
+    if self.__socket is not None:
+      self.__socket.close()
+      self.__socket = None
+      try:
+        os.remove(self.__path)
+      except OSError:
+        pass
+
+  def serve(self):
+    """Serve requests until interrupted or stopped by a client."""
+    self.__listen()
+    # Terminate cleanly, removing the socket.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+      while True:
+        connection, _ = self.__socket.accept()
+        with connection:
+          reply = self.__serve(connection)
+        if reply is not None and 'reload' in reply:
+          sys.stdout.flush()
+          sys.stderr.flush()
+          os.execv(sys.executable, [sys.executable] + ARGV)
+        if reply is not None and reply.get('stop'):
+          return
+    except KeyboardInterrupt:
+      pass
+    finally:
+      self.__close()
+
+  def __serve(self, connection):
+    channel = Channel(connection)
+    try:
+      channel.send({'pid': os.getpid()})
+      request = channel.recv()
+    except (EOFError, OSError, ValueError):
+      for fd in channel.fds:
+        os.close(fd)
+      return None
+    if request.get('stop'):
+      reply = {'status': 0, 'stop': True}
+    else:
+      reply = self.__run(request, channel.fds)
+    if 'reload' in reply:
+      # Stop accepting before replying, so the client retries on the
+      # restarted server.
+      self.__close()
+    try:
+      channel.send(reply)
+    except OSError:
+      pass
+    return reply
+
+  def __run(self, request, fds):
+    saved = []
+    try:
+      for stream in (sys.stdout, sys.stderr):
+        stream.flush()
+      for fd, target in zip(fds, (1, 2)):
+        saved.append((os.dup(target), target))
+        os.dup2(fd, target)
+      return self.__handler(request['argv'], request['environ'])
+    finally:
+      for stream in (sys.stdout, sys.stderr):
+        try:
+          stream.flush()
+        except OSError:
+          pass
+      for fd, target in saved:
+        os.dup2(fd, target)
+        os.close(fd)
+      for fd in fds:
+        os.close(fd)
+
+
+def _connect(path):
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(str(path))
+    return s
+  except OSError:
+    s.close()
+    return None
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+    return True
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+
+
+def request(path, argv, stop = False):
+  """Have the server listening on path run drake with argv.
+
+  Return the build exit status, or None if no server is running or
+  it cannot serve the request, in which case the caller builds by
+  itself.
+
+  path -- The path of the server socket.
+  argv -- The command line.
+  stop -- Stop the server instead of building.
+  """
+  if not os.path.exists(str(path)):
+    return None
+  try:
+    fds = [sys.stdout.fileno(), sys.stderr.fileno()]
+  except (AttributeError, OSError, ValueError):
+    # The output is not backed by files, as when captured.
+    return None
+  reloading = None
+  while True:
+    s = _connect(path)
+    if s is None:
+      # Wait for a reloading server to be back.
+      if reloading is not None and _alive(reloading):
+        time.sleep(0.05)
+        continue
+      return None
+    with s:
+      channel = Channel(s)
+      try:
+        pid = channel.recv()['pid']
+        sys.stdout.flush()
+        sys.stderr.flush()
+        channel.send({'argv': list(argv),
+                      'environ': dict(os.environ),
+                      'stop': stop}, fds)
+        try:
+          reply = channel.recv()
+        except KeyboardInterrupt:
+          # Interrupt the build, the server still replies.
+          os.kill(pid, signal.SIGINT)
+          reply = channel.recv()
+      except (EOFError, OSError, ValueError) as e:
+        print('%s: lost connection to the build server: %s' % (argv[0], e),
+              file = sys.stderr)
+        return 1
+    if 'reload' in reply:
+      print('%s: %s, restarting the build server'
+            % (argv[0], reply['reload']), file = sys.stderr)
+      reloading = pid
+      continue
+    if 'local' in reply:
+      print('%s: %s, not using the build server'
+            % (argv[0], reply['local']), file = sys.stderr)
+      return None
+    return reply['status']
@@ -0,0 +1,129 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''Cached file metadata.
+
+Whether a file exists, and its type, are answered from a listing of
+its directory, read once with os.scandir for all the files it
+contains. Metadata obtained through the listing entries is kept
+along with them, so each file is stat'ed at most once too. Listings
+are forgotten when the files they contain are modified, see
+StatCache.invalidate.
+'''
+
+import errno
+import os
+
+
+class Uncached:
+
+  """File metadata, straight from the filesystem."""
+
+  def exists(self, path):
+    """Whether path exists, dangling symbolic links included."""
+    return os.path.lexists(path)
+
+  def is_file(self, path):
+    """Whether path is a regular file, or a link to one."""
+    return os.path.isfile(path)
+
+  def lstat(self, path):
+    """The stat of path, not following symbolic links."""
+    return os.lstat(path)
+
+  def invalidate(self, path):
+    """Forget what is known about path, which was modified."""
+    pass
+
+  def clear(self):
+    """Forget everything."""
+    pass
+
+
+class StatCache(Uncached):
+
+  """File metadata, cached per directory listing.
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as d:
+  ...   cache = StatCache()
+  ...   with open('%s/file' % d, 'w') as f:
+  ...     pass
+  ...   print(cache.exists('%s/file' % d), cache.is_file(d))
+  ...   os.remove('%s/file' % d)
+  ...   print(cache.exists('%s/file' % d))
+  ...   cache.invalidate('%s/file' % d)
+  ...   print(cache.exists('%s/file' % d))
+  True False
+  True
+  False
+  """
+
+  def __init__(self):
+    # Directory -> {name: os.DirEntry}, or None if it cannot be
+    # listed.
+    self.__listings = {}
+
+  def __listing(self, directory):
+    res = self.__listings.get(directory, False)
+    if res is False:
+      res = {}
+      try:
+        with os.scandir(directory or '.') as entries:
+          for entry in entries:
+            res[entry.name] = entry
+      except (FileNotFoundError, NotADirectoryError):
+        pass
+      except OSError:
+        # Unreadable directories may still have reachable files.
+        res = None
+      # Other threads may have listed it meanwhile.
+      res = self.__listings.setdefault(directory, res)
+    return res
+
+  def __entry(self, path):
+    """The entry for path, None if it does not exist, or False if
+    unknown."""
+    directory, name = os.path.split(os.path.normpath(path))
+    if name in ('', '.', '..'):
+      return False
+    listing = self.__listing(directory)
+    if listing is None:
+      return False
+    return listing.get(name)
+
+  def exists(self, path):
+    entry = self.__entry(path)
+    if entry is False:
+      return super().exists(path)
+    return entry is not None
+
+  def is_file(self, path):
+    entry = self.__entry(path)
+    if entry is False:
+      return super().is_file(path)
+    try:
+      return entry is not None and entry.is_file()
+    except OSError:
+      return False
+
+  def lstat(self, path):
+    entry = self.__entry(path)
+    if entry is False:
+      return super().lstat(path)
+    if entry is None:
+      raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return entry.stat(follow_symlinks = False)
+
+  def invalidate(self, path):
+    path = os.path.normpath(path)
+    for directory in (os.path.dirname(path), path):
+      self.__listings.pop(directory, None)
+
+  def clear(self):
+    self.__listings.clear()
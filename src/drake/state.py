@@ -0,0 +1,184 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+import io
+import os
+import pickle
+import sqlite3
+import threading
+
+import drake
+
+
+class State:
+
+  """Persistent build state database.
+
+  All the state drake keeps between runs (dependency files, builder
+  hashes, ...) is stored in a single SQLite database instead of one
+  small file per builder. Entries are grouped in namespaces; a
+  namespace is loaded with a single query the first time it is
+  accessed, and modifications are kept in memory until flush writes
+  them back in one transaction.
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as d:
+  ...   state = State('%s/state.db' % d)
+  ...   state.set('colors', 'apple', 'red')
+  ...   state.flush()
+  ...   state = State('%s/state.db' % d)
+  ...   state.get('colors', 'apple')
+  'red'
+  """
+
+  def __init__(self, path):
+    """Create a state database.
+
+    path -- Path to the database file. It is created on the first
+            flush that has something to write.
+    """
+    self.__path = os.path.abspath(str(path))
+    self.__connection = None
+    self.__lock = threading.RLock()
+    # namespace -> key -> pickled value, as loaded from the database.
+    self.__raw = {}
+    # namespace -> key -> value, for unpickled or assigned values.
+    self.__values = {}
+    # (namespace, key) pairs to write or delete on flush.
+    self.__dirty = set()
+    # Namespaces to empty on flush, before writing.
+    self.__cleared = set()
+
+  @property
+  def path(self):
+    """The path to the database file."""
+    return self.__path
+
+  def __connect(self, create):
+    if self.__connection is None:
+      if not create and not os.path.exists(self.__path):
+        return None
+      os.makedirs(os.path.dirname(self.__path), exist_ok = True)
+      self.__connection = sqlite3.connect(self.__path,
+                                          check_same_thread = False)
+      self.__connection.execute(
+        'CREATE TABLE IF NOT EXISTS state ('
+        'namespace TEXT NOT NULL, '
+        'key TEXT NOT NULL, '
+        'value BLOB NOT NULL, '
+        'PRIMARY KEY (namespace, key))')
+    return self.__connection
+
+  def __load(self, namespace):
+    raw = self.__raw.get(namespace)
+    if raw is None:
+      raw = {}
+      connection = self.__connect(create = False)
+      if connection is not None:
+        with drake.profile_unpickling():
+          try:
+            for key, value in connection.execute(
+                'SELECT key, value FROM state WHERE namespace = ?',
+                (namespace,)):
+              raw[key] = value
+          except sqlite3.DatabaseError as e:
+            drake.warn('unable to read build state %s: %s' % (
+              self.__path, e))
+      self.__raw[namespace] = raw
+      self.__values[namespace] = {}
+    return raw
+
+  def keys(self, namespace):
+    """The keys stored in namespace."""
+    with self.__lock:
+      raw = self.__load(namespace)
+      return set(raw).union(self.__values[namespace])
+
+  def get(self, namespace, key, default = None):
+    """The value stored for key in namespace, or default."""
+    with self.__lock:
+      raw = self.__load(namespace)
+      values = self.__values[namespace]
+      if key in values:
+        return values[key]
+      value = raw.pop(key, None)
+      if value is None:
+        return default
+      with drake.profile_unpickling():
+        try:
+          value = drake.Path.Unpickler(io.BytesIO(value)).load()
+        except Exception:
+          return default
+      values[key] = value
+      return value
+
+  def set(self, namespace, key, value):
+    """Store value for key in namespace.
+
+    The value is written to disk on the next flush. Mutable values
+    must be set again after being modified for the change to be
+    saved.
+    """
+    with self.__lock:
+      self.__load(namespace)
+      self.__values[namespace][key] = value
+      self.__dirty.add((namespace, key))
+
+  def remove(self, namespace, key):
+    """Remove key from namespace."""
+    with self.__lock:
+      raw = self.__load(namespace)
+      raw.pop(key, None)
+      self.__values[namespace].pop(key, None)
+      self.__dirty.add((namespace, key))
+
+  def clear(self, namespace):
+    """Remove all keys from namespace."""
+    with self.__lock:
+      self.__raw[namespace] = {}
+      self.__values[namespace] = {}
+      self.__dirty = set(entry for entry in self.__dirty
+                         if entry[0] != namespace)
+      self.__cleared.add(namespace)
+
+  def flush(self):
+    """Write all pending modifications in a single transaction."""
+    with self.__lock:
+      if not self.__dirty and not self.__cleared:
+        return
+      with drake.profile_pickling():
+        updates = []
+        removals = []
+        for namespace, key in self.__dirty:
+          values = self.__values[namespace]
+          if key in values:
+            f = io.BytesIO()
+            drake.Path.Pickler(f).dump(values[key])
+            updates.append((namespace, key, f.getvalue()))
+          else:
+            removals.append((namespace, key))
+        connection = self.__connect(create = True)
+        with connection:
+          connection.executemany(
+            'DELETE FROM state WHERE namespace = ?',
+            [(namespace,) for namespace in self.__cleared])
+          connection.executemany(
+            'INSERT OR REPLACE INTO state (namespace, key, value) '
+            'VALUES (?, ?, ?)', updates)
+          connection.executemany(
+            'DELETE FROM state WHERE namespace = ? AND key = ?', removals)
+        self.__dirty.clear()
+        self.__cleared.clear()
+
+  def close(self):
+    """Flush and close the database."""
+    with self.__lock:
+      self.flush()
+      if self.__connection is not None:
+        self.__connection.close()
+        self.__connection = None
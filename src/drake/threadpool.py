@@ -6,84 +6,187 @@
 #
 # See the LICENSE file for more information.
 
-import sys
+import collections
+import concurrent.futures
+import os
 import threading
+import time
 
 class ThreadPool:
 
-  class Runner(threading.Thread):
+  """A bounded pool of threads running jobs in submission order.
 
-    def __init__(self, pool):
-      threading.Thread.__init__(self)
-      self.__cond = threading.Condition()
-      self.__f = None
-      self.__pool = pool
-      self.__ready = False
-      self.__stop = False
-      self.start()
+  Threads are started on demand, up to size; jobs submitted while
+  all of them are busy wait in a queue. The pool keeps counters of
+  the queue depth, the time jobs spent waiting and the time threads
+  spent running them, see statistics.
+  """
 
-    def run(self):
-      while True:
-        #print('%s: process' % self, file = sys.stderr)
-        with self.__cond:
-          if self.__stop:
-            #print('%s: stop' % self)
-            self.__pool._ThreadPool__threads.remove(self)
-            return
-          if self.__f is None:
-            #print('%s: wait for job' % self, file = sys.stderr)
-            self.__cond.wait()
-          if self.__stop:
-            #print('%s: stop' % self, file = sys.stderr)
-            try:
-              self.__pool._ThreadPool__threads.remove(self)
-            except:
-              # If the thread was starting a job, it was already
-              # removed from the set, but that's OK.
-              pass
-            return
-        #print('%s: run job' % self, file = sys.stderr)
-        self.__f()
-        self.__f = None
-        with self.__pool._ThreadPool__lock:
-          #print('%s: register as available' % self, file = sys.stderr)
-          self.__pool._ThreadPool__running.remove(self)
-          self.__pool._ThreadPool__threads.add(self)
-
-    def wake(self, f):
-      with self.__cond:
-        self.__f = f
+  def __init__(self, size = None):
+    """Create a pool.
+
+    size -- The maximum number of threads, defaults to the number of
+            CPUs.
+    """
+    self.__size = size or os.cpu_count() or 1
+    self.__threads = []
+    self.__idle = 0
+    self.__queue = collections.deque()
+    self.__cond = threading.Condition()
+    self.__stop = False
+    self.__start = time.time()
+    self.__stopped = None
+    self.__submitted = 0
+    self.__completed = 0
+    self.__queue_max = 0
+    self.__wait_time = 0
+    self.__busy_time = 0
+
+  @property
+  def size(self):
+    """The maximum number of threads."""
+    return self.__size
+
+  def run(self, f):
+    """Run f in a thread of the pool."""
+    with self.__cond:
+      if self.__stop:
+        raise Exception('thread pool is stopped')
+      self.__queue.append((f, time.time()))
+      self.__submitted += 1
+      self.__queue_max = max(self.__queue_max, len(self.__queue))
+      if self.__idle:
         self.__cond.notify()
+      elif len(self.__threads) < self.__size:
+        thread = threading.Thread(target = self.__run,
+                                  name = 'drake pool %s' % len(self.__threads),
+                                  daemon = True)
+        self.__threads.append(thread)
+        thread.start()
 
-    def stop(self):
+  def __run(self):
+    while True:
       with self.__cond:
-        self.__stop = True
-        self.__cond.notify()
-      self.join()
+        while not self.__queue and not self.__stop:
+          self.__idle += 1
+          self.__cond.wait()
+          self.__idle -= 1
+        if self.__stop:
+          return
+        f, submitted = self.__queue.popleft()
+        start = time.time()
+        self.__wait_time += start - submitted
+      try:
+        f()
+      finally:
+        with self.__cond:
+          self.__busy_time += time.time() - start
+          self.__completed += 1
 
-  def __init__(self):
-    self.__threads = set()
-    self.__running = set()
-    self.__lock = threading.Semaphore(1)
-    self.__cond = threading.Condition()
+  def stop(self):
+    """Wait for the running jobs and stop the threads.
 
-  def run(self, f):
+    Jobs still waiting in the queue are dropped.
+    """
+    with self.__cond:
+      self.__stop = True
+      self.__queue.clear()
+      self.__cond.notify_all()
+      threads = list(self.__threads)
+    for thread in threads:
+      thread.join()
+    with self.__cond:
+      if self.__stopped is None:
+        self.__stopped = time.time()
+
+  def statistics(self):
+    """Counters about the pool activity.
+
+    threads     -- The number of threads started.
+    submitted   -- The number of jobs submitted.
+    completed   -- The number of jobs completed.
+    queued      -- The number of jobs waiting for a thread.
+    queue_max   -- The maximum number of jobs waiting for a thread.
+    wait        -- The total time jobs waited for a thread, in seconds.
+    busy        -- The total time threads ran jobs, in seconds.
+    utilization -- The fraction of the pool capacity used.
+
+    >>> import threading
+    >>> pool = ThreadPool(2)
+    >>> done = threading.Semaphore(0)
+    >>> for i in range(4):
+    ...   pool.run(done.release)
+    >>> for i in range(4):
+    ...   _ = done.acquire()
+    >>> pool.stop()
+    >>> stats = pool.statistics()
+    >>> stats['submitted'], stats['completed'], stats['threads'] <= 2
+    (4, 4, True)
+    """
+    with self.__cond:
+      elapsed = (self.__stopped or time.time()) - self.__start
+      return {
+        'threads': len(self.__threads),
+        'submitted': self.__submitted,
+        'completed': self.__completed,
+        'queued': len(self.__queue),
+        'queue_max': self.__queue_max,
+        'wait': self.__wait_time,
+        'busy': self.__busy_time,
+        'utilization':
+          self.__busy_time / (self.__size * elapsed) if elapsed else 0,
+      }
+
+  def __str__(self):
+    return '%s threads: %s jobs, %.2fs waiting, %.0f%% utilization' % (
+      self.__size, self.__submitted, self.__wait_time,
+      self.statistics()['utilization'] * 100)
+
+
+class ProcessPool:
+
+  """A bounded pool of processes, for Python code bound by the GIL.
+
+  Functions and their arguments are sent to the worker processes and
+  must thus be picklable.
+  """
+
+  def __init__(self, size = None):
+    """Create a pool.
+
+    size -- The number of processes, defaults to the number of CPUs.
+    """
+    self.__size = size or os.cpu_count() or 1
+    self.__executor = None
+    self.__lock = threading.Lock()
+    self.__submitted = 0
+
+  @property
+  def size(self):
+    """The maximum number of processes."""
+    return self.__size
+
+  def run(self, f, args, callback):
+    """Run f(*args) in a process, then callback(future) in a thread."""
     with self.__lock:
-      if self.__threads:
-        thread = iter(self.__threads).__next__()
-        self.__threads.remove(thread)
-      else:
-        thread = ThreadPool.Runner(self)
-      self.__running.add(thread)
-    thread.wake(f)
+      if self.__executor is None:
+        self.__executor = concurrent.futures.ProcessPoolExecutor(
+          self.__size)
+      self.__submitted += 1
+      future = self.__executor.submit(f, *args)
+    future.add_done_callback(callback)
 
   def stop(self):
-    threads = set()
-    # Collect the Threads and then stop them. Do not stop the Threads
-    # while holding self.__lock, because Thread.stop joins the thread,
-    # which might require self.__lock to finish, hence a dead-lock.
+    """Wait for the pending jobs and stop the processes."""
     with self.__lock:
-      threads = threads.union(self.__threads)
-      threads = threads.union(self.__running)
-    for thread in threads:
-      thread.stop()
+      executor = self.__executor
+      self.__executor = None
+    if executor is not None:
+      executor.shutdown()
+
+  def statistics(self):
+    """Counters about the pool activity."""
+    return {
+      'processes': self.__size,
+      'submitted': self.__submitted,
+    }
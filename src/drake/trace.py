@@ -0,0 +1,170 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''Build activity traces, in the Chrome trace event format.
+
+The resulting files can be loaded in chrome://tracing or Perfetto.
+Activity is grouped in processes (the scheduler, builders and jobs),
+each with a track per slot: a builder or job takes the lowest free
+slot for its duration, so the number of tracks shows the concurrency
+and gaps show idle slots.
+'''
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+import drake.log
+
+
+class Trace:
+
+  """A trace being recorded.
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as d:
+  ...   trace = Trace('%s/trace.json' % d)
+  ...   with trace.track('jobs') as track:
+  ...     with trace.span('jobs', track, 'compile', 'job'):
+  ...       pass
+  ...   trace.write()
+  ...   with open('%s/trace.json' % d) as f:
+  ...     events = json.load(f)['traceEvents']
+  >>> [e['name'] for e in events if e['ph'] == 'X']
+  ['compile']
+  """
+
+  current = None
+
+  GROUPS = {
+    'scheduler': 1,
+    'builders': 2,
+    'jobs': 3,
+  }
+
+  def __init__(self, path):
+    """Create a trace.
+
+    path -- Where to write the trace.
+    """
+    self.__path = str(path)
+    self.__events = []
+    self.__lock = threading.Lock()
+    self.__origin = time.perf_counter()
+    # group -> set of free slots below the high water mark.
+    self.__free = {}
+    # group -> number of slots ever used.
+    self.__slots = {}
+
+  @property
+  def path(self):
+    """Where the trace is written."""
+    return self.__path
+
+  def __now(self):
+    return (time.perf_counter() - self.__origin) * 1e6
+
+  @contextlib.contextmanager
+  def track(self, group):
+    """Take the lowest free slot of group for the duration."""
+    with self.__lock:
+      free = self.__free.setdefault(group, set())
+      if free:
+        slot = min(free)
+        free.remove(slot)
+      else:
+        slot = self.__slots.get(group, 0)
+        self.__slots[group] = slot + 1
+    try:
+      yield slot
+    finally:
+      with self.__lock:
+        self.__free[group].add(slot)
+
+  @contextlib.contextmanager
+  def span(self, group, track, name, category, args = None):
+    """Record the duration of the enclosed code on a track."""
+    start = self.__now()
+    try:
+      yield
+    finally:
+      event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': start,
+        'dur': self.__now() - start,
+        'pid': Trace.GROUPS[group],
+        'tid': track,
+      }
+      if args is not None:
+        event['args'] = args
+      with self.__lock:
+        self.__events.append(event)
+
+  def instant(self, group, track, name, category, args = None):
+    """Record an instantaneous event on a track."""
+    event = {
+      'name': name,
+      'cat': category,
+      'ph': 'i',
+      's': 't',
+      'ts': self.__now(),
+      'pid': Trace.GROUPS[group],
+      'tid': track,
+    }
+    if args is not None:
+      event['args'] = args
+    with self.__lock:
+      self.__events.append(event)
+
+  def write(self):
+    """Write the events recorded so far."""
+    with self.__lock:
+      events = list(self.__events)
+      slots = dict(self.__slots)
+    metadata = []
+    for group, pid in Trace.GROUPS.items():
+      metadata.append({
+        'name': 'process_name', 'ph': 'M', 'pid': pid,
+        'args': {'name': group},
+      })
+      for slot in range(slots.get(group, 1)):
+        metadata.append({
+          'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': slot,
+          'args': {'name': '%s %s' % (group, slot)},
+        })
+    directory = os.path.dirname(self.__path)
+    if directory:
+      os.makedirs(directory, exist_ok = True)
+    with open(self.__path, 'w') as f:
+      json.dump({'traceEvents': metadata + events,
+                 'displayTimeUnit': 'ms'}, f)
+
+
+def track(group):
+  """Take a slot of group in the current trace, if any."""
+  trace = Trace.current
+  return drake.log.NOOP if trace is None else trace.track(group)
+
+
+def span(group, track, name, category, args = None):
+  """Record a span in the current trace, if any."""
+  trace = Trace.current
+  if trace is None:
+    return drake.log.NOOP
+  return trace.span(group, track, name, category, args)
+
+
+def instant(group, track, name, category, args = None):
+  """Record an instant event in the current trace, if any."""
+  trace = Trace.current
+  if trace is not None:
+    trace.instant(group, track, name, category, args)
@@ -0,0 +1,188 @@
+# Copyright (C) 2009-2017, Quentin "mefyl" Hocquet
+#
+# This software is provided "as is" without warranty of any kind,
+# either expressed or implied, including but not limited to the
+# implied warranties of fitness for a particular purpose.
+#
+# See the LICENSE file for more information.
+
+'''Notification of file modifications, for drake --watch.
+
+Directories are watched rather than files, so files created later,
+or replaced by editors saving through a temporary file, are noticed.
+Linux inotify is used when available, otherwise watched directories
+are polled.
+'''
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+class Watcher:
+
+  """Interface of file modification watchers."""
+
+  def watch(self, directory):
+    """Watch the files of directory, if it exists."""
+    raise NotImplementedError()
+
+  def wait(self):
+    """Wait for modifications and return the paths of the modified
+    files, or None if modifications may have been missed."""
+    raise NotImplementedError()
+
+  def close(self):
+    pass
+
+
+def _path(directory, name):
+  return os.path.normpath(os.path.join(directory, name))
+
+
+class Inotify(Watcher):
+
+  """Watch directories with Linux inotify.
+
+  >>> import tempfile
+  >>> with tempfile.TemporaryDirectory() as d:
+  ...   watcher = Inotify()
+  ...   watcher.watch(d)
+  ...   with open('%s/file' % d, 'w') as f:
+  ...     _ = f.write('content')
+  ...   changed = watcher.wait()
+  ...   watcher.close()
+  >>> [os.path.basename(p) for p in changed]
+  ['file']
+  """
+
+  IN_MODIFY = 0x2
+  IN_ATTRIB = 0x4
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ONLYDIR = 0x1000000
+
+  MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+         IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+  EVENT = struct.Struct('iIII')
+
+  def __init__(self, settle = 0.05):
+    """Create a watcher.
+
+    settle -- How long to keep collecting modifications after the
+              first one, in seconds, so files saved together are
+              reported together.
+    """
+    self.__libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                              use_errno = True)
+    self.__fd = self.__libc.inotify_init1(os.O_CLOEXEC)
+    if self.__fd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno))
+    self.__settle = settle
+    self.__directories = {}
+
+  def watch(self, directory):
+    if directory in self.__directories.values():
+      return
+    wd = self.__libc.inotify_add_watch(
+      self.__fd, os.fsencode(directory), Inotify.MASK)
+    if wd >= 0:
+      self.__directories[wd] = directory
+
+  def __read(self, res):
+    data = os.read(self.__fd, 65536)
+    offset = 0
+    while offset < len(data):
+      wd, mask, _, length = Inotify.EVENT.unpack_from(data, offset)
+      offset += Inotify.EVENT.size
+      name = data[offset:offset + length].rstrip(b'\0')
+      offset += length
+      if mask & Inotify.IN_Q_OVERFLOW:
+        return None
+      directory = self.__directories.get(wd)
+      if mask & Inotify.IN_IGNORED:
+        # The directory was removed.
+        self.__directories.pop(wd, None)
+      elif directory is not None and name:
+        res.add(_path(directory, os.fsdecode(name)))
+    return res
+
+  def wait(self):
+    res = set()
+    select.select([self.__fd], [], [])
+    deadline = time.time() + self.__settle
+    while res is not None:
+      res = self.__read(res)
+      remaining = deadline - time.time()
+      if remaining <= 0 or not select.select([self.__fd], [], [],
+                                             remaining)[0]:
+        break
+    return res
+
+  def close(self):
+    if self.__fd >= 0:
+      os.close(self.__fd)
+      self.__fd = -1
+
+
+class Polling(Watcher):
+
+  """Watch directories by listing them periodically."""
+
+  def __init__(self, interval = 0.5):
+    """Create a watcher.
+
+    interval -- The time between listings, in seconds.
+    """
+    self.__interval = interval
+    self.__directories = {}
+
+  @staticmethod
+  def __list(directory):
+    res = {}
+    try:
+      with os.scandir(directory) as entries:
+        for entry in entries:
+          try:
+            st = entry.stat(follow_symlinks = False)
+          except OSError:
+            continue
+          res[entry.name] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    except OSError:
+      pass
+    return res
+
+  def watch(self, directory):
+    if directory not in self.__directories:
+      self.__directories[directory] = self.__list(directory)
+
+  def wait(self):
+    while True:
+      time.sleep(self.__interval)
+      res = set()
+      for directory, previous in self.__directories.items():
+        current = self.__list(directory)
+        for name in set(previous) | set(current):
+          if previous.get(name) != current.get(name):
+            res.add(_path(directory, name))
+        self.__directories[directory] = current
+      if res:
+        return res
+
+
+def watcher():
+  """The best watcher available on this system."""
+  try:
+    return Inotify()
+  except (AttributeError, OSError, TypeError):
+    return Polling()